@@ -4,14 +4,19 @@
 import os
 import json
 import time
+import queue
 import threading
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from urllib.parse import urlparse
 
-from config import DEFAULT_DOWNLOAD_CONFIG, DEFAULT_OUTPUT_DIR
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import DEFAULT_DOWNLOAD_CONFIG, DEFAULT_HEADERS, DEFAULT_OUTPUT_DIR
 from models import DownloadResult, VideoInfo
+from rate_limiter import AIMDConcurrencyLimiter, HostRateLimiter
 from segment_downloader import SegmentDownloader
-from utils import save_download_report
+from utils import save_download_report, dump_json_line
+from video_merger import VideoMerger
 
 class BatchDownloader:
     """批量下载器类"""
@@ -25,13 +30,25 @@ class BatchDownloader:
         self.keep_segments = keep_segments  # 添加keep_segments参数
         
         # 确保输出目录存在
-        if not os.path.exists(self.output_base_dir):
-            os.makedirs(self.output_base_dir)
+        os.makedirs(self.output_base_dir, exist_ok=True)
         
         # 数据结构
         self.video_list = []
         self.download_results = []
         self.lock = threading.Lock()
+        # 按主机(netloc)共享的HTTP会话，复用TCP/TLS连接
+        self.session_pool = {}
+        # 日志队列，由单独的线程负责输出，避免工作线程争用stdout
+        self.log_q = queue.Queue()
+        self._log_thread = None
+        # 根据各主机的耗时和错误情况动态调整同时下载的视频数
+        self.concurrency = AIMDConcurrencyLimiter(
+            self.max_concurrent_videos,
+            max_limit=self.max_concurrent_videos * 4,
+            target_latency=DEFAULT_DOWNLOAD_CONFIG.get('target_request_latency', 2)
+        )
+        # 按主机限制每分钟请求数，避免突发请求触发服务器限流
+        self.limiter = HostRateLimiter(rpm=DEFAULT_DOWNLOAD_CONFIG.get('rpm_per_host', 0))
         
         # 统计信息
         self.total_videos = 0
@@ -54,27 +71,20 @@ class BatchDownloader:
                 print(f"错误: JSON文件不存在: {self.json_file_path}")
                 return False
                 
-            with open(self.json_file_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
-            # 解析JSON数据结构
-            if 'links' in data and isinstance(data['links'], list):
-                self.video_list = data['links']
-            elif isinstance(data, list):
-                # 如果直接是链接列表
-                self.video_list = data
-            else:
+            video_list = self._read_video_list()
+            if video_list is None:
                 print("错误: JSON文件格式不正确")
                 return False
+            self.video_list = self._dedup_video_list(VideoInfo.from_entry(entry) for entry in video_list)
             
             self.total_videos = len(self.video_list)
             print(f"成功加载 {self.total_videos} 个M3U8链接")
+            if len(video_list) > self.total_videos:
+                print(f"已去除 {len(video_list) - self.total_videos} 个重复或无效的链接")
             
             # 显示加载的链接概览
             for i, video_info in enumerate(self.video_list[:5]):
-                url = video_info.get('url', '') if isinstance(video_info, dict) else str(video_info)
-                domain = video_info.get('domain', 'Unknown') if isinstance(video_info, dict) else urlparse(url).netloc
-                print(f"  {i+1}. {domain} - {url[:60]}...")
+                print(f"  {i+1}. {video_info.domain} - {video_info.url[:60]}...")
                 
             if self.total_videos > 5:
                 print(f"  ... 还有 {self.total_videos - 5} 个链接")
@@ -88,41 +98,115 @@ class BatchDownloader:
             print(f"错误: 读取JSON文件失败: {e}")
             return False
     
+    def _read_video_list(self):
+        """读取JSON文件中的链接列表，格式不正确时返回None"""
+        # 去重、排序和进度统计都需要完整的链接列表，直接整体解析即可
+        with open(self.json_file_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        
+        # 解析JSON数据结构
+        if isinstance(data, dict) and isinstance(data.get('links'), list):
+            return data['links']
+        elif isinstance(data, list):
+            # 如果直接是链接列表
+            return data
+        return None
+    
+    def _dedup_video_list(self, video_infos):
+        """去除URL为空或重复的链接，保留首次出现的顺序"""
+        seen = set()
+        video_list = []
+        for video_info in video_infos:
+            if video_info.url and video_info.url not in seen:
+                seen.add(video_info.url)
+                video_list.append(video_info)
+        return video_list
+    
+    def _log(self, message):
+        """将日志消息放入队列，由日志线程统一输出"""
+        self.log_q.put(message)
+    
+    def _log_worker(self):
+        """日志线程：从队列中取出消息并打印"""
+        while True:
+            message = self.log_q.get()
+            if message is None:
+                return
+            print(message)
+    
+    def _start_log_thread(self):
+        """启动日志线程"""
+        self._log_thread = threading.Thread(target=self._log_worker, daemon=True)
+        self._log_thread.start()
+    
+    def _stop_log_thread(self):
+        """输出队列中剩余的消息并停止日志线程"""
+        if self._log_thread is not None:
+            self.log_q.put(None)
+            self._log_thread.join()
+            self._log_thread = None
+    
+    def _get_session(self, host):
+        """获取指定主机的共享会话"""
+        with self.lock:
+            session = self.session_pool.get(host)
+            if session is None:
+                session = requests.Session()
+                session.headers.update(DEFAULT_HEADERS)
+                # 连接池容量按该主机可能同时进行的最大请求数设置，
+                # 避免并发超过池容量时连接被丢弃而无法保持长连接
+                adapter = HTTPAdapter(
+                    pool_connections=self.max_concurrent_videos,
+                    pool_maxsize=self.concurrency.max_limit * self.max_workers_per_video,
+                    # 重试统一由SegmentDownloader处理，429、5xx等响应直接交给调用方统计和限速
+                    max_retries=0
+                )
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self.session_pool[host] = session
+            return session
+    
+    def _close_sessions(self):
+        """关闭所有共享会话"""
+        with self.lock:
+            for session in self.session_pool.values():
+                session.close()
+            self.session_pool.clear()
+    
+    def _get_custom_headers(self, video_info):
+        """从视频信息中提取请求头"""
+        custom_headers = {}
+        if video_info.headers:
+            headers = video_info.headers
+            if 'userAgent' in headers:
+                custom_headers['User-Agent'] = headers['userAgent']
+            if 'referer' in headers:
+                custom_headers['Referer'] = headers['referer']
+            if 'origin' in headers:
+                custom_headers['Origin'] = headers['origin']
+            if 'cookie' in headers:
+                custom_headers['Cookie'] = headers['cookie']
+        return custom_headers
+    
     def _create_downloader(self, video_info):
         """创建下载器实例"""
-        if isinstance(video_info, dict):
-            m3u8_url = video_info.get('url', '')
-            # 从视频信息中提取请求头
-            custom_headers = {}
-            if 'headers' in video_info:
-                headers = video_info['headers']
-                if 'userAgent' in headers:
-                    custom_headers['User-Agent'] = headers['userAgent']
-                if 'referer' in headers:
-                    custom_headers['Referer'] = headers['referer']
-                if 'origin' in headers:
-                    custom_headers['Origin'] = headers['origin']
-                if 'cookie' in headers:
-                    custom_headers['Cookie'] = headers['cookie']
-        else:
-            m3u8_url = str(video_info)
-            custom_headers = {}
-        
         # 注意：在批量下载模式下，我们不直接在SegmentDownloader中处理keep_segments
         # 而是在合并成功后根据BatchDownloader的keep_segments参数决定是否清理
         return SegmentDownloader(
-            m3u8_url=m3u8_url,
+            m3u8_url=video_info.url,
             max_workers=self.max_workers_per_video,
             max_retries=3,
             retry_delay=2,
-            custom_headers=custom_headers,
-            output_dir=self.output_base_dir  # 传入output_base_dir参数
+            custom_headers=self._get_custom_headers(video_info),
+            output_dir=self.output_base_dir,  # 传入output_base_dir参数
+            session=self._get_session(video_info.host),
+            rate_limiter=self.limiter
         )
     
     def _download_single_video(self, video_info, index):
         """下载单个视频"""
-        url = video_info.get('url', '') if isinstance(video_info, dict) else str(video_info)
-        domain = video_info.get('domain', 'Unknown') if isinstance(video_info, dict) else urlparse(url).netloc
+        url = video_info.url
+        domain = video_info.domain
         
         result = DownloadResult(
             index=index,
@@ -131,12 +215,14 @@ class BatchDownloader:
             status='pending'
         )
         
+        # 等待并发许可
+        self.concurrency.acquire()
+        downloader = None
+        
         try:
             result.start_time = time.time()
             
-            with self.lock:
-                print(f"\n[{index+1}/{self.total_videos}] 开始下载: {domain}")
-                print(f"URL: {url[:80]}...")
+            self._log(f"\n[{index+1}/{self.total_videos}] 开始下载: {domain}\nURL: {url[:80]}...")
             
             # 创建下载器
             downloader = self._create_downloader(video_info)
@@ -152,7 +238,6 @@ class BatchDownloader:
             
             if success:
                 # 合并视频片段到指定的输出目录
-                from video_merger import VideoMerger
                 merger = VideoMerger(downloader.temp_dir, downloader.segments, self.output_base_dir)
                 if merger.merge_segments():
                     result.status = 'completed'
@@ -160,14 +245,11 @@ class BatchDownloader:
                     
                     # 只有在合并成功后才根据参数决定是否清理临时文件
                     if self.keep_segments:
-                        print(f"[{index+1}/{self.total_videos}] 已保留原始视频切片文件")
+                        self._log(f"[{index+1}/{self.total_videos}] 已保留原始视频切片文件")
                     else:
                         downloader.cleanup()
                     
-                    with self.lock:
-                        self.completed_videos += 1
-                        print(f"\n✅ [{index+1}/{self.total_videos}] 下载完成: {domain}")
-                        print(f"输出目录: {self.output_base_dir}")
+                    self._log(f"\n✅ [{index+1}/{self.total_videos}] 下载完成: {domain}\n输出目录: {self.output_base_dir}")
                 else:
                     result.status = 'failed'
                     result.error = '视频合并失败'
@@ -179,17 +261,51 @@ class BatchDownloader:
             result.status = 'failed'
             result.error = str(e)
             
-            with self.lock:
-                self.failed_videos += 1
-                print(f"\n❌ [{index+1}/{self.total_videos}] 下载失败: {domain}")
-                print(f"错误: {result.error}")
+            self._log(f"\n❌ [{index+1}/{self.total_videos}] 下载失败: {domain}\n错误: {result.error}")
         
         finally:
             result.end_time = time.time()
             result.duration = result.end_time - result.start_time if result.start_time else 0
+            if downloader is not None:
+                self.concurrency.release(video_info.host, downloader.average_latency(), downloader.overload_count > 0)
+            else:
+                self.concurrency.release(video_info.host)
         
         return result
     
+    def _estimate_size(self, video_info):
+        """通过HEAD请求获取M3U8文件大小，用于估计视频片段数量，获取失败时返回None"""
+        try:
+            self.limiter.wait_if_throttled(video_info.host)
+            response = self._get_session(video_info.host).head(
+                video_info.url, headers=self._get_custom_headers(video_info), timeout=10, allow_redirects=True
+            )
+            content_length = response.headers.get('Content-Length')
+            if response.ok and content_length and content_length.isdigit():
+                return int(content_length)
+        except Exception:
+            pass
+        return None
+    
+    def _order_videos(self):
+        """确定下载顺序，保留原始索引
+        
+        视频按主机分组，使同一主机的视频连续下载以复用连接；
+        启用sort_by_size时先并行获取各M3U8文件大小，同一主机内较小的视频优先下载，大小未知的排在最后
+        """
+        ordered = list(enumerate(self.video_list))
+        sizes = [None] * len(ordered)
+        if DEFAULT_DOWNLOAD_CONFIG.get('sort_by_size', False):
+            print("正在获取各视频的M3U8文件大小以确定下载顺序...")
+            with ThreadPoolExecutor(max_workers=self.max_concurrent_videos * self.max_workers_per_video) as executor:
+                sizes = list(executor.map(self._estimate_size, self.video_list))
+        
+        keys = [
+            (video_info.host, size if size is not None else float('inf'))
+            for size, (_, video_info) in zip(sizes, ordered)
+        ]
+        return [item for _, item in sorted(zip(keys, ordered), key=lambda t: t[0])]
+    
     def start_batch_download(self):
         """开始批量下载"""
         if not self.video_list:
@@ -202,13 +318,22 @@ class BatchDownloader:
         print("=" * 80)
         
         self.start_time = time.time()
+        self._start_log_thread()
+        
+        # 按视频索引存放结果，保证报告顺序与输入一致
+        self.download_results = [None] * self.total_videos
         
-        # 使用线程池执行并发下载
-        with ThreadPoolExecutor(max_workers=self.max_concurrent_videos) as executor:
+        # 每完成一个视频就追加一行结果，程序中途被终止时已完成的结果也不会丢失
+        results_file = os.path.join(self.output_base_dir, f'download_results_{time.strftime("%Y%m%d_%H%M%S")}.ndjson')
+        print(f"下载结果将实时写入: {results_file}")
+        
+        # 使用线程池执行并发下载，实际并发数由并发控制器限制
+        with open(results_file, 'ab') as results_fp, \
+                ThreadPoolExecutor(max_workers=self.concurrency.max_limit) as executor:
             # 提交所有下载任务
             future_to_video = {
                 executor.submit(self._download_single_video, video_info, i): (video_info, i)
-                for i, video_info in enumerate(self.video_list)
+                for i, video_info in self._order_videos()
             }
             
             # 等待任务完成并收集结果
@@ -216,18 +341,27 @@ class BatchDownloader:
                 video_info, index = future_to_video[future]
                 try:
                     result = future.result()
-                    self.download_results.append(result)
+                    self.download_results[index] = result
+                    results_fp.write(dump_json_line(result.to_dict()))
+                    results_fp.flush()
+                    
+                    # 统计只在当前线程中更新，无需加锁
+                    if result.status == 'completed':
+                        self.completed_videos += 1
+                    elif result.status == 'failed':
+                        self.failed_videos += 1
                     
                     # 显示进度
-                    completed = len([r for r in self.download_results if r.status in ['completed', 'failed']])
+                    completed = self.completed_videos + self.failed_videos
                     progress = (completed / self.total_videos) * 100
                     
-                    with self.lock:
-                        print(f"\n总进度: {progress:.1f}% ({completed}/{self.total_videos})")
-                        print(f"成功: {self.completed_videos} | 失败: {self.failed_videos}")
+                    self._log(f"\n总进度: {progress:.1f}% ({completed}/{self.total_videos})\n"
+                              f"成功: {self.completed_videos} | 失败: {self.failed_videos}")
                         
                 except Exception as e:
-                    print(f"处理下载任务时出错: {e}")
+                    self._log(f"处理下载任务时出错: {e}")
+        
+        self._stop_log_thread()
         
         # 显示最终结果
         self._show_final_results()
@@ -238,6 +372,9 @@ class BatchDownloader:
         end_time = time.time()
         total_duration = end_time - self.start_time if self.start_time else 0
         
+        # 所有视频已处理完毕，释放连接池
+        self._close_sessions()
+        
         print("\n" + "=" * 80)
         print("批量下载完成!")
         print("=" * 80)
@@ -252,14 +389,14 @@ class BatchDownloader:
             print(f"平均每个视频: {avg_time:.1f} 秒")
         
         # 显示失败的视频详情
-        failed_results = [r for r in self.download_results if r.status == 'failed']
+        failed_results = [r for r in self.download_results if r is not None and r.status == 'failed']
         if failed_results:
             print(f"\n失败的视频详情:")
             for result in failed_results:
                 print(f"  ❌ {result.domain}: {result.error}")
         
         # 显示成功的视频路径
-        success_results = [r for r in self.download_results if r.status == 'completed']
+        success_results = [r for r in self.download_results if r is not None and r.status == 'completed']
         if success_results:
             print(f"\n成功下载的视频:")
             for result in success_results:
@@ -282,20 +419,7 @@ class BatchDownloader:
                 'max_workers_per_video': self.max_workers_per_video,
                 'output_base_dir': self.output_base_dir
             },
-            'results': [
-                {
-                    'index': r.index,
-                    'url': r.url,
-                    'domain': r.domain,
-                    'status': r.status,
-                    'error': r.error,
-                    'output_dir': r.output_dir,
-                    'start_time': r.start_time,
-                    'end_time': r.end_time,
-                    'duration': r.duration
-                }
-                for r in self.download_results
-            ]
+            'results': [r.to_dict() for r in self.download_results if r is not None]
         }
         
         save_download_report(self.output_base_dir, report_data)
\ No newline at end of file
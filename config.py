@@ -34,7 +34,10 @@ def get_default_config():
             'max_concurrent_videos': 3,
             'max_workers_per_video': 10,
             'keep_segments': False,
-            'abort_on_error': False
+            'abort_on_error': False,
+            'target_request_latency': 2,
+            'rpm_per_host': 0,
+            'sort_by_size': False
         },
         "ffmpeg_paths": [
             r"C:\Soft\ffmpeg\ffmpeg.exe",  # 用户指定的路径
@@ -42,7 +45,8 @@ def get_default_config():
         ],
         "temp_file_names": {
             "state_file": 'download_state.json',
-            "file_list": 'file_list.txt'
+            "file_list": 'file_list.txt',
+            "manifest_file": 'manifest.json'
         },
         "output_dir": os.path.join(os.getcwd(), 'downloads')
     }
@@ -56,4 +60,5 @@ DEFAULT_DOWNLOAD_CONFIG = CONFIG['download_config']
 FFMPEG_PATHS = CONFIG['ffmpeg_paths']
 STATE_FILE_NAME = CONFIG['temp_file_names']['state_file']
 FILE_LIST_NAME = CONFIG['temp_file_names']['file_list']
-DEFAULT_OUTPUT_DIR = CONFIG['output_dir'] if not CONFIG['output_dir'].startswith('downloads') else os.path.join(os.getcwd(), CONFIG['output_dir'])
\ No newline at end of file
+MANIFEST_FILE_NAME = CONFIG['temp_file_names'].get('manifest_file', 'manifest.json')
+DEFAULT_OUTPUT_DIR = CONFIG['output_dir'] if not CONFIG['output_dir'].startswith('downloads') else os.path.join(os.getcwd(), CONFIG['output_dir'])
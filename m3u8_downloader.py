@@ -5,20 +5,33 @@ M3U8视频下载器 (向后兼容版本)
 """
 
 import os
-import re
 import sys
+import math
+import base64
 import hashlib
 import json
 import requests
+import urllib3
+import urllib.request
+from requests.adapters import HTTPAdapter
 import time
 import subprocess
 import shutil
 import threading
+import logging
+import signal
+import argparse
+import functools
+import contextlib
 from datetime import datetime
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib.parse import urlparse, urljoin
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.backends import default_backend
+try:
+    import orjson  # 可选依赖，安装后加快JSON序列化
+except ImportError:
+    orjson = None
 
 # 默认请求头
 DEFAULT_HEADERS = {
@@ -44,38 +57,318 @@ FFMPEG_PATHS = [
 
 # 临时文件名
 STATE_FILE_NAME = 'download_state.json'
-FILE_LIST_NAME = 'file_list.txt'
+PLAYLIST_CACHE_NAME = 'playlist.json'
+COMPLETED_FILE_NAME = 'completed.json'  # 记录已完整下载的视频输出路径，重复运行时跳过
+STATE_SAVE_INTERVAL = 2  # 下载状态写盘间隔（秒）
+PROGRESS_INTERVAL = 0.25  # 进度刷新间隔（秒）
+
+# 自动调整线程数：先顺序下载的片段数，以及线程数的上下限
+PROBE_SEGMENT_COUNT = 3
+AUTO_WORKERS_MIN = 4
+AUTO_WORKERS_MAX = 64
 
 # 输出目录
 DEFAULT_OUTPUT_DIR = os.path.join(os.getcwd(), 'downloads')
 
+# 命令行入口的输出日志，级别由 --quiet / --verbose 控制
+logger = logging.getLogger(__name__)
+
+# 收到Ctrl+C或SIGTERM后置位，各下载线程在开始下一个片段前检查并停止
+_STOP = threading.Event()
+
+# OpenSSL后端（支持AES-NI硬件加速），所有片段共用
+_BACKEND = default_backend()
+
+# 加密m3u8的密钥行标签
+_KEY_TAG = '#EXT-X-KEY:'
+_VARIANT_TAG = '#EXT-X-STREAM-INF:'
+
+_JSON_ENCODER = json.JSONEncoder(ensure_ascii=False)
+
+# 批量下载报告头部的字段固定不变，直接用格式化字符串生成，结果列表随后逐条写入
+_REPORT_HEADER_FMT = (
+    '{"timestamp":"%s","total_videos":%d,"completed_videos":%d,"failed_videos":%d,'
+    '"total_duration":%r,"average_duration":%r,"settings":{"max_concurrent_videos":%d,'
+    '"max_workers_per_video":%d,"output_base_dir":%s},"results":['
+)
+
+def _json_bytes(obj):
+    """把对象序列化为紧凑的UTF-8 JSON字节串，安装了orjson时优先使用"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return _JSON_ENCODER.encode(obj).encode('utf-8')
+
+def _parse_attributes(text):
+    """解析m3u8标签的属性列表（NAME=VALUE,...），带引号的值中可以包含逗号"""
+    attrs = {}
+    pos = 0
+    length = len(text)
+    while pos < length:
+        eq = text.find('=', pos)
+        if eq < 0:
+            break
+        name = text[pos:eq].strip()
+        if eq + 1 < length and text[eq + 1] == '"':
+            end = text.find('"', eq + 2)
+            if end < 0:
+                end = length
+            value = text[eq + 2:end]
+            comma = text.find(',', end)
+        else:
+            comma = text.find(',', eq + 1)
+            value = text[eq + 1:comma if comma >= 0 else length].strip()
+        attrs[name] = value
+        if comma < 0:
+            break
+        pos = comma + 1
+    return attrs
+
+def _parse_key_uri(key_line):
+    """从#EXT-X-KEY行中取出AES-128密钥的URI，格式不符时返回None"""
+    if not key_line.startswith(_KEY_TAG):
+        return None
+    attrs = _parse_attributes(key_line[len(_KEY_TAG):])
+    if attrs.get('METHOD') != 'AES-128':
+        return None
+    return attrs.get('URI') or None
+
+def _parse_key_iv(key_line):
+    """从#EXT-X-KEY行中取出IV的十六进制字符串，未指定时返回None"""
+    return _parse_attributes(key_line[len(_KEY_TAG):]).get('IV') or None
+
+def _select_variant(m3u8_content):
+    """从主播放列表中选出带宽最高的子列表地址，不是主播放列表时返回None"""
+    best_uri = None
+    best_bandwidth = -1
+    bandwidth = None
+    for line in m3u8_content.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith(_VARIANT_TAG):
+            value = _parse_attributes(line[len(_VARIANT_TAG):]).get('BANDWIDTH', '')
+            bandwidth = int(value) if value.isdigit() else 0
+        elif not line.startswith('#') and bandwidth is not None:
+            # #EXT-X-STREAM-INF的下一行就是子列表的URI
+            if bandwidth > best_bandwidth:
+                best_uri, best_bandwidth = line, bandwidth
+            bandwidth = None
+    return best_uri
+
+def _encode_bitmap(indices):
+    """把片段索引集合编码为base64位图字符串（每个片段占1位）"""
+    bitmap = bytearray((max(indices) + 8) // 8 if indices else 0)
+    for i in indices:
+        bitmap[i >> 3] |= 0x80 >> (i & 7)
+    return base64.b64encode(bitmap).decode('ascii')
+
+def _decode_bitmap(text):
+    """把base64位图字符串还原为片段索引集合"""
+    indices = set()
+    for byte_index, byte in enumerate(base64.b64decode(text)):
+        if byte:
+            base = byte_index << 3
+            for bit in range(8):
+                if byte & (0x80 >> bit):
+                    indices.add(base + bit)
+    return indices
+
+def _append_file(src, dst, size):
+    """把src的内容追加到dst，Linux下使用sendfile在内核中完成复制"""
+    if sys.platform.startswith('linux') and hasattr(os, 'sendfile'):
+        offset = 0
+        while offset < size:
+            sent = os.sendfile(dst.fileno(), src.fileno(), offset, size - offset)
+            if sent == 0:
+                # 文件比预期的短或sendfile不再前进时，剩余部分改用普通复制，不静默截断
+                src.seek(offset)
+                shutil.copyfileobj(src, dst, 1 << 20)
+                return
+            offset += sent
+    else:
+        shutil.copyfileobj(src, dst, 1 << 20)
+
+def _content_range_total(content_range):
+    """从Content-Range响应头（如 bytes 100-199/200）中取出文件总大小，未知时返回None"""
+    if not content_range or '/' not in content_range:
+        return None
+    total = content_range.rsplit('/', 1)[1].strip()
+    return int(total) if total.isdigit() else None
+
+def _fadvise(f, advice):
+    """对整个文件调用posix_fadvise，不支持的平台直接跳过"""
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(f.fileno(), 0, 0, getattr(os, advice))
+        except OSError:
+            pass
+
+def _file_size(path):
+    """返回文件大小，文件不存在时返回0（只调用一次stat）"""
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return 0
+
+def _preallocate_file(f, size):
+    """按预期大小预先分配文件空间，减少磁盘碎片（不支持的平台直接跳过）"""
+    if size and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+        except OSError:
+            pass
+
+def _create_pool_manager(maxsize, num_pools=1, headers=None):
+    """创建片段下载用的urllib3连接池"""
+    return urllib3.PoolManager(
+        num_pools=num_pools,
+        maxsize=maxsize,
+        headers=headers,
+        # 重试由_download_segment自己处理，这里只跟随重定向
+        retries=urllib3.Retry(total=None, connect=0, read=0, status=0, other=0, redirect=5),
+        cert_reqs='CERT_REQUIRED',
+        ca_certs=requests.certs.where()
+    )
+
+class SharedConnectionPool:
+    """批量下载时多个下载器共用的连接池（requests适配器 + urllib3连接池），跨视频复用长连接"""
+    
+    def __init__(self, maxsize, num_pools=64):
+        self.adapter = HTTPAdapter(pool_connections=num_pools, pool_maxsize=maxsize, max_retries=0)
+        # 与单个下载器一致：配置了代理时片段也走requests会话
+        self.http = None
+        if not urllib.request.getproxies():
+            self.http = _create_pool_manager(maxsize, num_pools)
+    
+    def close(self):
+        """关闭所有长连接"""
+        self.adapter.close()
+        if self.http is not None:
+            self.http.clear()
+
+class HostConnectionLimiter:
+    """按主机限制同时进行的连接数，可在多个下载器之间共享"""
+    
+    def __init__(self, limit):
+        self.limit = limit  # 每个主机的最大连接数，0表示不限制
+        self._semaphores = {}
+        self._lock = threading.Lock()
+    
+    def slot(self, url):
+        """返回该URL所在主机的连接许可（可用于with语句）"""
+        if self.limit <= 0:
+            return contextlib.nullcontext()
+        host = urlparse(url).netloc
+        with self._lock:
+            semaphore = self._semaphores.get(host)
+            if semaphore is None:
+                semaphore = self._semaphores[host] = threading.BoundedSemaphore(self.limit)
+        return semaphore
+
 class M3U8Downloader:
-    def __init__(self, m3u8_url, max_workers=10, max_retries=3, retry_delay=2, test_mode=False, custom_headers=None):
+    def __init__(self, m3u8_url, max_workers=10, max_retries=3, retry_delay=2, test_mode=False, custom_headers=None, auto_workers=False, conn_limiter=None, executor=None, connection_pool=None, dry_run=False):
         self.m3u8_url = m3u8_url
+        # 只解析不下载：不创建临时目录、不读写缓存和状态文件、不下载密钥
+        self.dry_run = dry_run
         self.max_workers = max_workers
+        self.auto_workers = auto_workers  # 根据前几个片段的耗时自动调整线程数
+        self._last_timing = None  # 最近一个片段的 (等待响应耗时, 总耗时)
+        # 每个主机的连接数上限，批量下载时由多个下载器共享
+        self.conn_limiter = conn_limiter or HostConnectionLimiter(0)
+        # 批量下载时多个视频共用的片段下载线程池，为None时每次下载自己创建
+        self.executor = executor
         self.max_retries = max_retries  # 最大重试次数
         self.retry_delay = retry_delay  # 重试间隔（秒）
         self.custom_headers = custom_headers or {}
-        self.temp_dir = self._create_temp_dir()
+        self.temp_dir = self._create_temp_dir(create=not dry_run)
         self.segments = []
+        self._segment_paths = ()  # 每个片段的本地文件路径，解析m3u8后一次性生成
         self.total_size = 0
         self.success_count = 0
         self.fail_count = 0
         self.retry_count = 0  # 重试次数统计
         self.start_time = None
+        # 实际下载片段的m3u8地址，传入的是主播放列表时会换成选中的子列表地址
+        self.playlist_url = m3u8_url
         self.base_url = self._get_base_url()
+        # 所有请求共用一个会话，保持长连接避免每个片段重新握手；
+        # 批量下载时传入共用的连接池，不同视频之间也能复用连接
+        self._shared_pool = connection_pool
+        self.session = requests.Session()
+        if connection_pool is not None:
+            adapter = connection_pool.adapter
+        else:
+            adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # 添加浏览器请求头，避免403错误
+        self.session.headers.update(self._get_headers())
+        # 片段下载直接使用urllib3连接池，省去requests每次请求的额外开销；
+        # 系统配置了代理时仍走requests会话，保证代理设置生效
+        self.http = None
+        self._segment_headers = None  # 使用共用连接池时，每个请求需要带上本视频的请求头
+        if connection_pool is not None:
+            self.http = connection_pool.http
+            self._segment_headers = dict(self.session.headers)
+        elif not urllib.request.getproxies():
+            self.http = _create_pool_manager(max_workers, headers=dict(self.session.headers))
         # 解密相关属性
         self.is_encrypted = False
         self.key_url = None
         self.key = None
         self.iv = None
+        self._aes = None  # 密钥对应的AES算法对象，下载密钥后只创建一次
+        self._key_executor = None  # 后台下载密钥用的单线程池，close()时关闭
+        self._key_future = None  # 后台下载密钥的任务，与片段下载并行进行
+        self._key_lock = threading.Lock()
+        self._ivs = None  # 未指定IV时，预先计算好的每个片段的IV
+        self._thread_local = threading.local()  # 每个下载线程各自的解密缓冲区
         # 测试模式：用于模拟部分片段下载失败
         self.test_mode = test_mode
         # 断点续传相关
         self.state_file = os.path.join(self.temp_dir, STATE_FILE_NAME)
+        self.playlist_file = os.path.join(self.temp_dir, PLAYLIST_CACHE_NAME)  # 缓存的m3u8内容及条件请求用的响应头
         self.downloaded_segments = set()  # 已成功下载的片段索引
         self.failed_segments = set()     # 下载失败的片段索引
-        self._load_download_state()
+        self._state_lock = threading.Lock()  # 只保护计数器和片段集合，不在锁内做磁盘IO
+        self._state_dirty = False            # 状态有变化、等待后台线程写盘
+        if not dry_run:
+            self._load_download_state()
+
+    def _request_segment(self, segment_url, start=0):
+        """请求片段数据（start>0时从该字节开始续传），返回 (响应对象, 按块读取数据的函数, 状态码)"""
+        if self.http is None:
+            headers = {'Range': f'bytes={start}-'} if start else None
+            response = self.session.get(segment_url, headers=headers, stream=True, timeout=60)
+            if not (start and response.status_code == 416):
+                response.raise_for_status()
+            return response, response.iter_content, response.status_code
+        
+        # urllib3传入headers时会替换连接池的默认请求头，需要合并
+        headers = self._segment_headers
+        if start:
+            headers = dict(headers or self.http.headers, Range=f'bytes={start}-')
+        response = self.http.request('GET', segment_url, headers=headers, preload_content=False, timeout=60)
+        if response.status >= 400 and not (start and response.status == 416):
+            response.release_conn()
+            raise urllib3.exceptions.HTTPError(f"HTTP {response.status} 错误: {segment_url}")
+        return response, response.stream, response.status
+
+    @staticmethod
+    def _raw_stream(response):
+        """返回可直接read()的底层响应流（自动解压gzip等编码）"""
+        if isinstance(response, requests.Response):
+            response.raw.decode_content = True
+            return response.raw
+        return response
+
+    @staticmethod
+    def _release_response(response):
+        """读取完毕后把连接还给连接池"""
+        if isinstance(response, requests.Response):
+            response.close()
+        else:
+            response.release_conn()
 
     def _get_headers(self):
         """获取请求头"""
@@ -84,16 +377,21 @@ class M3U8Downloader:
         headers['Referer'] = self.base_url
         return headers
 
-    def _create_temp_dir(self):
-        # 计算URL的哈希值作为目录名
-        url_hash = hashlib.md5(self.m3u8_url.encode()).hexdigest()
+    def _create_temp_dir(self, create=True):
+        # 计算URL的哈希值（BLAKE2b）作为目录名
+        url_hash = hashlib.blake2b(self.m3u8_url.encode(), digest_size=16).hexdigest()
         temp_dir = os.path.join(os.getcwd(), url_hash)
-        if not os.path.exists(temp_dir):
-            os.makedirs(temp_dir)
+        if not os.path.isdir(temp_dir):
+            # 兼容旧版本以MD5命名的临时目录，保证可以继续断点续传
+            legacy_dir = os.path.join(os.getcwd(), hashlib.md5(self.m3u8_url.encode(), usedforsecurity=False).hexdigest())
+            if os.path.isdir(legacy_dir):
+                return legacy_dir
+        if create:
+            os.makedirs(temp_dir, exist_ok=True)
         return temp_dir
 
     def _get_base_url(self):
-        parsed_url = urlparse(self.m3u8_url)
+        parsed_url = urlparse(self.playlist_url)
         base_url = f"{parsed_url.scheme}://{parsed_url.netloc}"
         path_parts = parsed_url.path.split('/')[:-1]
         if path_parts:
@@ -104,37 +402,36 @@ class M3U8Downloader:
 
     def _download_m3u8(self):
         try:
-            # 添加浏览器请求头，避免403错误
-            headers = self._get_headers()
+            m3u8_content = self._load_playlist()
             
-            response = requests.get(self.m3u8_url, headers=headers, timeout=30)
-            response.raise_for_status()
-            m3u8_content = response.text
+            # 逐行扫描一次，同时找出密钥行和所有ts片段的URL
+            key_line = None
+            segments = []
+            for line in m3u8_content.splitlines():
+                line = line.strip()
+                if not line:
+                    continue
+                if line.startswith('#'):
+                    if key_line is None and line.startswith('#EXT-X-KEY'):
+                        key_line = line
+                        # 发现密钥行后立即在后台下载密钥，继续解析剩余内容
+                        self._start_key_download(key_line)
+                elif line.endswith('.ts'):
+                    # 不以#开头且是独立的.ts文件，才是真正的TS片段URL
+                    segments.append(line)
             
             # 检查是否为加密的m3u8文件
-            if '#EXT-X-KEY' in m3u8_content:
+            if key_line is not None:
                 self.is_encrypted = True
                 print("检测到加密的m3u8文件，正在解析密钥信息...")
                 
-                # 解析密钥URL
-                key_match = re.search(r'#EXT-X-KEY:METHOD=AES-128,URI="(.*?)"', m3u8_content)
-                if key_match:
-                    self.key_url = key_match.group(1)
-                    # 确保密钥URL是完整的
-                    if not self.key_url.startswith('http'):
-                        self.key_url = urljoin(self.m3u8_url, self.key_url)
-                    
-                    # 下载密钥，添加请求头避免403错误
-                    print(f"正在下载密钥: {self.key_url}")
-                    key_headers = self._get_headers()
-                    key_response = requests.get(self.key_url, headers=key_headers, timeout=30)
-                    key_response.raise_for_status()
-                    self.key = key_response.content
+                if self.key_url:
+                    if not self.dry_run:
+                        print(f"正在后台下载密钥: {self.key_url}")
                     
                     # 解析IV（初始化向量）
-                    iv_match = re.search(r'IV=(.*?)(?:,|\r|\n)', m3u8_content)
-                    if iv_match:
-                        iv_hex = iv_match.group(1)
+                    iv_hex = _parse_key_iv(key_line)
+                    if iv_hex:
                         if iv_hex.startswith('0x'):
                             iv_hex = iv_hex[2:]
                         self.iv = bytes.fromhex(iv_hex)
@@ -147,142 +444,420 @@ class M3U8Downloader:
                     print("无法解析密钥信息")
                     return False
             
-            # 解析m3u8文件，获取所有ts片段的URL
-            # 改进正则表达式，更精确地匹配真正的TS片段URL（不包含#开头的行，且是独立的.ts文件）
-            ts_pattern = re.compile(r'^(?!#)[^\n]*\.ts\s*$', re.MULTILINE)
-            self.segments = ts_pattern.findall(m3u8_content)
-            
-            # 清理URL中的换行符和空白字符
-            self.segments = [segment.strip().replace('\n', '').replace('\r', '') for segment in self.segments]
-            
+            self.segments = self._resolve_segment_urls(segments)
+            self._segment_paths = tuple(os.path.join(self.temp_dir, f"segment_{i:05d}.ts") for i in range(len(segments)))
             if not self.segments:
                 print("未找到ts片段")
                 return False
             
+            if self.is_encrypted and self.iv is None:
+                # 通常IV是16字节的，这里预先计算每个片段序号的16字节表示
+                self._ivs = [i.to_bytes(16, byteorder='big') for i in range(len(self.segments))]
+            
             print(f"找到 {len(self.segments)} 个ts片段")
             return True
         except Exception as e:
             print(f"下载m3u8文件失败: {e}")
             return False
 
-    def _download_segment(self, segment_url, index):
+    def _load_playlist(self):
+        """获取m3u8内容；有缓存时发送条件请求，服务器确认未变化才使用缓存，保证片段序号与上次一致"""
+        # 只解析不下载时不读写缓存，只在内存中解析
+        cache = None if self.dry_run else self._read_playlist_cache()
+        url = self.m3u8_url
+        headers = {}
+        if cache:
+            # 从主播放列表选出的子列表地址也一并缓存，直接向它确认
+            url = cache.get('playlist_url') or url
+            if cache.get('etag'):
+                headers['If-None-Match'] = cache['etag']
+            if cache.get('last_modified'):
+                headers['If-Modified-Since'] = cache['last_modified']
+        
+        response = self.session.get(url, headers=headers, timeout=30)
+        if response.status_code == 304 and cache:
+            print("m3u8文件未变化，使用缓存继续下载")
+            self._set_playlist_url(url)
+            return cache['playlist']
+        response.raise_for_status()
+        m3u8_content = response.text
+        # 主播放列表只列出不同码率的子列表，没有ts片段，选带宽最高的子列表再下载一次
+        if _VARIANT_TAG in m3u8_content:
+            variant = _select_variant(m3u8_content)
+            if variant:
+                url = urljoin(url, variant)
+                print(f"检测到主播放列表，选择最高码率: {url}")
+                response = self.session.get(url, timeout=30)
+                response.raise_for_status()
+                m3u8_content = response.text
+        self._set_playlist_url(url)
+        if cache and cache['playlist'] != m3u8_content:
+            # 片段序号可能已经对不上，之前下载的片段和状态都不能再用
+            print("m3u8文件已变化，丢弃之前下载的片段，重新开始下载")
+            self._discard_segments()
+        if not self.dry_run:
+            self._save_playlist_cache(m3u8_content, response)
+        return m3u8_content
+
+    def _discard_segments(self):
+        """删除临时目录中的所有片段文件，并清空下载状态"""
+        with os.scandir(self.temp_dir) as entries:
+            for entry in entries:
+                name = entry.name
+                if name.startswith('segment_') and name.endswith(('.ts', '.ts.part')) and entry.is_file():
+                    os.remove(entry.path)
+        with self._state_lock:
+            self.downloaded_segments = set()
+            self.failed_segments = set()
+            self._state_dirty = False
+        if os.path.exists(self.state_file):
+            os.remove(self.state_file)
+
+    def _read_playlist_cache(self):
+        """读取缓存的m3u8内容，不存在或不是当前视频的缓存时返回None"""
+        try:
+            with open(self.playlist_file, 'rb') as f:
+                data = f.read()
+            cache = orjson.loads(data) if orjson is not None else json.loads(data)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(cache, dict) or cache.get('url') != self.m3u8_url or not cache.get('playlist'):
+            return None
+        return cache
+
+    def _save_playlist_cache(self, m3u8_content, response):
+        """缓存m3u8内容及用于条件请求的ETag/Last-Modified（与片段状态一样先写临时文件再重命名）"""
+        cache = {
+            'url': self.m3u8_url,
+            'playlist_url': self.playlist_url,
+            'playlist': m3u8_content,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified')
+        }
+        temp_file = self.playlist_file + '.tmp'
+        with open(temp_file, 'wb') as f:
+            f.write(_json_bytes(cache))
+        os.replace(temp_file, self.playlist_file)
+
+    def _set_playlist_url(self, playlist_url):
+        """切换到子列表地址，片段和密钥的相对地址都以它为基准"""
+        self.playlist_url = playlist_url
+        self.base_url = self._get_base_url()
+
+    def _scan_segment_files(self):
+        """遍历一次临时目录，返回 {片段索引: 文件大小}"""
+        sizes = {}
+        with os.scandir(self.temp_dir) as entries:
+            for entry in entries:
+                name = entry.name
+                if name.startswith('segment_') and name.endswith('.ts') and entry.is_file():
+                    try:
+                        sizes[int(name[8:-3])] = entry.stat().st_size
+                    except ValueError:
+                        continue
+        return sizes
+
+    def _start_key_download(self, key_line):
+        """解析密钥URL并在后台线程中开始下载密钥"""
+        key_uri = _parse_key_uri(key_line)
+        if not key_uri:
+            return
+        # 确保密钥URL是完整的
+        if not key_uri.startswith('http'):
+            key_uri = urljoin(self.playlist_url, key_uri)
+        self.key_url = key_uri
+        if self.dry_run:
+            return
+        if self._key_executor is None:
+            self._key_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='key')
+        self._key_future = self._key_executor.submit(self.session.get, self.key_url, timeout=30)
+
+    def _get_aes(self):
+        """获取解密用的AES算法对象，密钥还没下载完时等待后台任务"""
+        with self._key_lock:
+            if self._aes is None:
+                future, self._key_future = self._key_future, None
+                if future is not None:
+                    key_response = future.result()
+                else:
+                    # 后台下载失败过，重新同步下载
+                    key_response = self.session.get(self.key_url, timeout=30)
+                key_response.raise_for_status()
+                self.key = key_response.content
+                self._aes = algorithms.AES(self.key)
+            return self._aes
+
+    def _decrypt_buffer(self, size):
+        """返回当前线程复用的解密输出缓冲区，容量至少为 size + 16 字节"""
+        buf = getattr(self._thread_local, 'decrypt_buffer', None)
+        if buf is None or len(buf) < size + 16:
+            buf = bytearray(size + 16)
+            self._thread_local.decrypt_buffer = buf
+        return buf
+
+    def _resolve_segment_urls(self, segments):
+        """把所有片段的相对地址一次性补全为完整URL"""
+        parsed_url = urlparse(self.playlist_url)
+        host_root = f"{parsed_url.scheme}://{parsed_url.netloc}"
+        base_url = self.base_url
+        return [
+            url if url.startswith('http') else (host_root + url if url.startswith('/') else base_url + url)
+            for url in segments
+        ]
+
+    def estimate_size(self):
+        """用第一个片段的大小乘以片段数估算视频总大小，无法获取时返回None"""
+        if not self.segments:
+            return None
+        try:
+            response = self.session.head(self.segments[0], timeout=5, allow_redirects=True)
+            content_length = int(response.headers.get('Content-Length') or 0)
+        except Exception:
+            return None
+        return content_length * len(self.segments) if content_length else None
+
+    def _download_segment(self, segment_url, index, check_existing=True):
         retries = 0
         success = False
         last_error = None
         
-        # 检查文件是否已存在且完整
-        segment_path = os.path.join(self.temp_dir, f"segment_{index:05d}.ts")
-        if os.path.exists(segment_path) and os.path.getsize(segment_path) > 0:
+        # 已请求停止时不再开始新的片段
+        if _STOP.is_set():
+            return
+        
+        # 检查文件是否已存在且完整（调用方已扫描过目录时可跳过）
+        segment_path = self._segment_paths[index]
+        part_path = segment_path + '.part'
+        if check_existing and _file_size(segment_path) > 0:
             print(f"\n片段 {index} 已存在且完整，跳过下载")
-            self.downloaded_segments.add(index)
-            self.success_count += 1
+            self._record_segment(index, True)
             return
         
         # 测试模式：模拟部分片段下载失败（每5个片段中让第3个和第5个失败）
         if self.test_mode and (index % 5 == 2 or index % 5 == 4):
-            self.fail_count += 1
-            self.failed_segments.add(index)
+            self._record_segment(index, False)
             # 清理失败片段的本地文件
-            segment_path = os.path.join(self.temp_dir, f"segment_{index:05d}.ts")
             if os.path.exists(segment_path):
                 os.remove(segment_path)
             print(f"\n测试模式: 模拟片段 {index} 下载失败")
-            self._save_download_state()
             return
         
-        # 确保URL是完整的
-        if not segment_url.startswith('http'):
-            if segment_url.startswith('/'):
-                parsed_url = urlparse(self.m3u8_url)
-                segment_url = f"{parsed_url.scheme}://{parsed_url.netloc}{segment_url}"
-            else:
-                segment_url = f"{self.base_url}{segment_url}"
-        
-        # 添加浏览器请求头
-        headers = self._get_headers()
-        
         # 下载和重试逻辑
-        while retries <= self.max_retries and not success:
+        while retries <= self.max_retries and not success and not _STOP.is_set():
             try:
                 # 如果是重试，打印重试信息
                 if retries > 0:
-                    self.retry_count += 1
+                    with self._state_lock:
+                        self.retry_count += 1
                     print(f"\n重试下载片段 {index} (第{retries}次/{self.max_retries}次)")
-                    # 等待指定的重试间隔
-                    time.sleep(self.retry_delay)
+                    # 等待指定的重试间隔，期间收到停止请求则立即结束
+                    if _STOP.wait(self.retry_delay):
+                        break
                 
                 # 下载ts片段
-                response = requests.get(segment_url, headers=headers, stream=True, timeout=60)
-                response.raise_for_status()
-                
-                # 保存文件
-                file_path = os.path.join(self.temp_dir, f"segment_{index:05d}.ts")
-                
-                # 检查是否需要解密
-                if self.is_encrypted and self.key:
-                    # 读取加密数据
-                    encrypted_data = response.content
-                    
-                    # 设置IV（如果未指定，使用片段序号）
-                    if self.iv is None:
-                        # 通常IV是16字节的，这里使用index的16字节表示
-                        iv = index.to_bytes(16, byteorder='big')
-                    else:
-                        iv = self.iv
-                    
-                    # 创建解密器
-                    cipher = Cipher(algorithms.AES(self.key), modes.CBC(iv), backend=default_backend())
-                    decryptor = cipher.decryptor()
+                # 占用一个该主机的连接许可，读取完毕后归还
+                with self.conn_limiter.slot(segment_url):
+                    # 片段先写入.part文件，未加密时之前中断留下的部分可以用Range请求续传；
+                    # 加密片段需要从头解密，总是重新下载
+                    start = 0 if self.is_encrypted else _file_size(part_path)
                     
-                    # 解密数据
-                    decrypted_data = decryptor.update(encrypted_data) + decryptor.finalize()
+                    request_start = time.time()
+                    response, read_chunks, status = self._request_segment(segment_url, start)
+                    response_latency = time.time() - request_start
+                    expected_size = int(response.headers.get('Content-Length') or 0)
+                
+                    try:
+                        if status == 416:
+                            # 服务器认为续传位置无效，丢弃.part文件后重新下载
+                            os.remove(part_path)
+                            raise IOError(f"片段 {index} 续传位置无效，将重新下载")
+                        
+                        # 检查是否需要解密
+                        if self.is_encrypted:
+                            # 设置IV（如果未指定，使用片段序号）
+                            if self.iv is None:
+                                iv = self._ivs[index]
+                            else:
+                                iv = self.iv
                     
-                    # 保存解密后的数据
-                    with open(file_path, 'wb') as f:
-                        f.write(decrypted_data)
+                            # 创建解密器（复用AES算法对象，只有IV随片段变化）
+                            cipher = Cipher(self._get_aes(), modes.CBC(iv), backend=_BACKEND)
+                            decryptor = cipher.decryptor()
                     
-                    self.total_size += len(decrypted_data)
-                else:
-                    # 直接保存未加密的数据
-                    with open(file_path, 'wb') as f:
-                        for chunk in response.iter_content(chunk_size=8192):
-                            if chunk:
-                                f.write(chunk)
-                                self.total_size += len(chunk)
-                
-                self.success_count += 1
-                success = True
-                self.downloaded_segments.add(index)
-                self.failed_segments.discard(index)
-                
-                # 显示下载进度
-                if self.start_time is not None:
-                    elapsed_time = time.time() - self.start_time
-                    speed = self.total_size / elapsed_time if elapsed_time > 0 else 0
-                else:
-                    elapsed_time = 0
-                    speed = 0
-                progress = (self.success_count + self.fail_count) / len(self.segments) * 100
+                            # 边下载边解密写入，不在内存中保留整个片段；
+                            # 解密结果依次写入每个线程复用的1MB缓冲区，攒满后才写一次文件，
+                            # 省去Python缓冲层的额外复制。
+                            # 先写入.part文件，全部解密完成后再重命名，中断时不会留下不完整的片段文件
+                            buf = self._decrypt_buffer(1 << 20)
+                            view = memoryview(buf)
+                            pending = 0
+                            with open(part_path, 'wb', buffering=0) as f:
+                                _preallocate_file(f, expected_size)
+                                for chunk in read_chunks(64 * 1024):
+                                    if chunk:
+                                        if pending + len(chunk) + 16 > len(buf):
+                                            # 无缓冲文件可能只写入一部分，循环直到写完
+                                            written = 0
+                                            while written < pending:
+                                                written += f.write(view[written:pending])
+                                            pending = 0
+                                            if len(chunk) + 16 > len(buf):
+                                                buf = self._decrypt_buffer(len(chunk))
+                                                view = memoryview(buf)
+                                        pending += decryptor.update_into(chunk, view[pending:])
+                                # 写入缓冲区中剩余的解密数据；CBC模式下finalize()只是结束解密器，
+                                # 不会再输出数据，也不会去除PKCS7填充（与之前整段解密时的行为一致）
+                                decryptor.finalize()
+                                written = 0
+                                while written < pending:
+                                    written += f.write(view[written:pending])
+                                segment_size = f.tell()
+                                # 去掉预分配多出的部分
+                                f.truncate()
+                            os.replace(part_path, segment_path)
+                        else:
+                            # 直接保存未加密的数据；206表示服务器支持续传，追加到已有内容之后
+                            resumed = status == 206
+                            with open(part_path, 'ab' if resumed else 'wb') as f:
+                                if not resumed:
+                                    _preallocate_file(f, expected_size)
+                                # 直接从底层连接按1MB块复制到文件，不再逐个8KB数据块循环
+                                start_pos = f.tell()
+                                try:
+                                    shutil.copyfileobj(self._raw_stream(response), f, 1 << 20)
+                                finally:
+                                    # 无论是否读取完整都去掉预分配多出的部分，
+                                    # 使.part文件大小等于实际收到的字节数，下次才能从正确的位置续传
+                                    f.truncate()
+                                written_size = f.tell()
+                                segment_size = written_size - start_pos
+                            
+                            # 续传时核对文件总大小，不一致则丢弃重新下载
+                            if resumed:
+                                total = _content_range_total(response.headers.get('Content-Range'))
+                                if total and written_size != total:
+                                    os.remove(part_path)
+                                    raise IOError(f"片段 {index} 续传后大小不一致 ({written_size}/{total})，将重新下载")
+                            os.replace(part_path, segment_path)
                 
-                sys.stdout.write(f"\r下载进度: {progress:.2f}% | 成功: {self.success_count} | 失败: {self.fail_count} | 重试: {self.retry_count} | 速度: {speed/1024/1024:.2f} MB/s")
-                sys.stdout.flush()
+                        success = True
+                        self._last_timing = (response_latency, time.time() - request_start)
+                        self._record_segment(index, True, segment_size)
+                    finally:
+                        self._release_response(response)
                 
             except Exception as e:
                 last_error = e
                 retries += 1
         
+        # 因停止请求而中断的片段不记为失败，只删除可能不完整的文件，下次继续下载
+        if not success and _STOP.is_set():
+            if os.path.exists(segment_path):
+                os.remove(segment_path)
+            return
+        
         # 如果所有重试都失败
         if not success:
-            self.fail_count += 1
-            self.failed_segments.add(index)
+            self._record_segment(index, False)
             # 清理失败片段的本地文件
-            segment_path = os.path.join(self.temp_dir, f"segment_{index:05d}.ts")
             if os.path.exists(segment_path):
                 os.remove(segment_path)
             print(f"\n下载片段 {index} 失败 (已尝试{retries-1}次): {last_error}")
-            
-        # 保存下载状态
-        self._save_download_state()
+
+    def _record_segment(self, index, success, size=0):
+        """记录片段下载结果，只更新内存中的状态，由后台线程定期写盘"""
+        with self._state_lock:
+            if success:
+                self.success_count += 1
+                self.total_size += size
+                self.downloaded_segments.add(index)
+                self.failed_segments.discard(index)
+            else:
+                self.fail_count += 1
+                self.failed_segments.add(index)
+            self._state_dirty = True
+
+    def _print_progress(self):
+        """显示下载进度"""
+        # 在锁内取一份一致的计数快照，输出时不占用锁
+        with self._state_lock:
+            success_count = self.success_count
+            fail_count = self.fail_count
+            retry_count = self.retry_count
+            total_size = self.total_size
+        
+        if self.start_time is not None:
+            elapsed_time = time.time() - self.start_time
+            speed = total_size / elapsed_time if elapsed_time > 0 else 0
+        else:
+            speed = 0
+        progress = (success_count + fail_count) / len(self.segments) * 100
+        
+        sys.stdout.write(f"\r下载进度: {progress:.2f}% | 成功: {success_count} | 失败: {fail_count} | 重试: {retry_count} | 速度: {speed/1024/1024:.2f} MB/s")
+        sys.stdout.flush()
+
+    def _progress_loop(self, stop_event):
+        """后台定时刷新进度，下载线程本身不再写终端"""
+        while not stop_event.wait(PROGRESS_INTERVAL):
+            self._print_progress()
+        self._print_progress()
+
+    def _run_segments(self, executor, segments_to_download):
+        """分批提交片段下载任务（排队中的任务最多为线程数的2倍），并等待全部完成"""
+        limit = self.max_workers * 2
+        slots = threading.BoundedSemaphore(limit)
+        
+        def task(segment, index):
+            try:
+                self._download_segment(segment, index, False)
+            finally:
+                slots.release()
+        
+        for segment, i in segments_to_download:
+            slots.acquire()
+            try:
+                executor.submit(task, segment, i)
+            except Exception:
+                slots.release()
+                raise
+        # 收回全部许可，说明所有任务都已结束
+        for _ in range(limit):
+            slots.acquire()
+
+    def _tune_max_workers(self, probe_segments):
+        """顺序下载前几个片段，根据等待响应与传输数据的耗时比例估算线程数"""
+        timings = []
+        for segment, i in probe_segments:
+            self._last_timing = None
+            self._download_segment(segment, i, False)
+            if self._last_timing:
+                timings.append(self._last_timing)
+        if not timings:
+            return
+        
+        latency = sum(t[0] for t in timings) / len(timings)
+        total = sum(t[1] for t in timings) / len(timings)
+        transfer = max(total - latency, 0.001)
+        # 单个请求只有transfer/total的时间在传输数据，需要足够的并发填满等待响应的空闲时间
+        workers = math.ceil(total / transfer)
+        self.max_workers = max(AUTO_WORKERS_MIN, min(workers, AUTO_WORKERS_MAX))
+        # 连接池大小随线程数调整，保证每个线程都能复用长连接（共用连接池时由批量下载器统一设置）
+        if self._shared_pool is None:
+            old_adapter = self.session.get_adapter('https://')
+            adapter = HTTPAdapter(pool_connections=self.max_workers, pool_maxsize=self.max_workers, max_retries=0)
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+            # 关闭被替换的适配器，释放其中的空闲连接
+            old_adapter.close()
+            if self.http is not None:
+                self.http.clear()
+                self.http = _create_pool_manager(self.max_workers, headers=dict(self.session.headers))
+        print(f"\n根据前 {len(timings)} 个片段的耗时自动调整线程数: {self.max_workers}")
+
+    def _state_saver_loop(self, stop_event):
+        """后台定期保存下载状态，避免每个片段都重写一次状态文件"""
+        while not stop_event.wait(STATE_SAVE_INTERVAL):
+            self._save_download_state()
 
     def download_all_segments(self):
         # 重新初始化计数器，确保准确
@@ -290,11 +865,17 @@ class M3U8Downloader:
         self.fail_count = 0
         self.retry_count = 0
         
-        # 计算需要下载的片段数量
+        # 状态文件中超出当前片段数的索引已经没有意义（如m3u8变短了），先去掉
+        segment_count = len(self.segments)
+        with self._state_lock:
+            self.failed_segments = {i for i in self.failed_segments if i < segment_count}
+            self.downloaded_segments = {i for i in self.downloaded_segments if i < segment_count}
+        
+        # 计算需要下载的片段数量，只遍历一次目录而不是逐个检查文件
+        segment_sizes = self._scan_segment_files()
         segments_to_download = []
         for i, segment in enumerate(self.segments):
-            segment_path = os.path.join(self.temp_dir, f"segment_{i:05d}.ts")
-            if not os.path.exists(segment_path) or os.path.getsize(segment_path) == 0 or i in self.failed_segments:
+            if not segment_sizes.get(i) or i in self.failed_segments:
                 segments_to_download.append((segment, i))
             else:
                 # 文件存在且不为空，视为下载成功
@@ -315,16 +896,37 @@ class M3U8Downloader:
             print(f"发现 {len(self.failed_segments)} 个标记为失败的片段，将重新下载")
             # 清理失败片段的本地文件
             for i in self.failed_segments:
-                segment_path = os.path.join(self.temp_dir, f"segment_{i:05d}.ts")
-                if os.path.exists(segment_path):
-                    os.remove(segment_path)
+                if i in segment_sizes:
+                    os.remove(self._segment_paths[i])
                     print(f"已删除失败片段文件: segment_{i:05d}.ts")
         
         self.start_time = time.time()
         
-        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            for segment, i in segments_to_download:
-                executor.submit(self._download_segment, segment, i)
+        stop_event = threading.Event()
+        saver = threading.Thread(target=self._state_saver_loop, args=(stop_event,), daemon=True)
+        reporter = threading.Thread(target=self._progress_loop, args=(stop_event,), daemon=True)
+        saver.start()
+        reporter.start()
+        try:
+            if self.auto_workers and len(segments_to_download) > PROBE_SEGMENT_COUNT:
+                self._tune_max_workers(segments_to_download[:PROBE_SEGMENT_COUNT])
+                segments_to_download = segments_to_download[PROBE_SEGMENT_COUNT:]
+            
+            if self.executor is not None:
+                self._run_segments(self.executor, segments_to_download)
+            else:
+                with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='segment') as executor:
+                    self._run_segments(executor, segments_to_download)
+        finally:
+            stop_event.set()
+            saver.join()
+            reporter.join()
+            # 下载结束或中断后，把最后一批变化写入状态文件
+            self._save_download_state()
+        
+        if _STOP.is_set():
+            print("\n下载已中断，已保存下载状态，下次运行可继续下载")
+            return False
         
         print("\n所有片段下载完成")
         
@@ -343,7 +945,7 @@ class M3U8Downloader:
             parsed_url = urlparse(self.m3u8_url)
             domain = parsed_url.netloc.replace('.', '_')  # 将域名中的点替换为下划线
             timestamp = time.strftime('%Y%m%d_%H%M%S')  # 添加时间戳
-            random_str = hashlib.md5(self.m3u8_url.encode()).hexdigest()[:8]  # 基于URL生成随机字符串
+            random_str = hashlib.blake2b(self.m3u8_url.encode(), digest_size=4).hexdigest()  # 基于URL生成随机字符串
             output_filename = f"{domain}_{timestamp}_{random_str}.mp4"
         
         # 确定输出路径
@@ -377,64 +979,130 @@ class M3U8Downloader:
             print("或者确保ffmpeg.exe位于 C:\\Soft\\ffmpeg\\ 目录下")
             
             # 询问用户是否要手动指定ffmpeg路径
-            choice = input("是否要手动指定ffmpeg的路径？(y/n): ").lower()
+            # 非交互式终端下不询问，直接给出手动合并的方法
+            choice = input("是否要手动指定ffmpeg的路径？(y/n): ").lower() if sys.stdin.isatty() else 'n'
             if choice == 'y':
                 ffmpeg_path = input("请输入ffmpeg可执行文件的完整路径: ").strip()
                 if not os.path.exists(ffmpeg_path):
                     print(f"指定的路径不存在: {ffmpeg_path}")
                     return False
             else:
+                # 不使用ffmpeg时直接按顺序拼接TS片段，TS格式本身支持直接拼接播放
+                ts_path = os.path.splitext(output_path)[0] + '.ts'
+                print(f"未使用ffmpeg，直接拼接TS片段到 {ts_path}")
+                try:
+                    self._concat_segments_ts(ts_path)
+                    # 没有得到MP4，不记录为已完成，也不算合并成功，片段保留下来供安装ffmpeg后重新合并
+                    print("拼接完成，如需MP4格式可安装ffmpeg后再转换:")
+                    print(f"ffmpeg -f mpegts -i \"{ts_path}\" -c copy \"{output_path}\"")
+                    return False
+                except Exception as e:
+                    print(f"拼接TS片段失败: {e}")
+                
                 # 如果用户不想指定ffmpeg路径，提供手动合并的方法
                 print("\n您可以稍后手动合并视频片段。合并方法：")
                 print(f"1. 安装ffmpeg")
                 print(f"2. 打开命令行，切换到目录: {self.temp_dir}")
-                print(f"3. 运行命令: ffmpeg -f concat -safe 0 -i {FILE_LIST_NAME} -c copy {output_filename}")
+                print(f"3. 运行命令: cat segment_*.ts | ffmpeg -f mpegts -i pipe:0 -c copy {output_filename}")
                 return False
         
-        # 创建文件列表
-        file_list_path = os.path.join(self.temp_dir, FILE_LIST_NAME)
-        with open(file_list_path, 'w', encoding='utf-8') as f:
-            for i in range(len(self.segments)):
-                segment_path = os.path.join(self.temp_dir, f"segment_{i:05d}.ts")
-                if os.path.exists(segment_path):
-                    f.write(f"file '{segment_path}'\n")
-        
         print(f"开始合并视频片段到 {output_path}")
         
-        # 使用ffmpeg合并视频
+        # 使用ffmpeg合并视频：按顺序把TS片段通过管道写给ffmpeg，不再生成文件列表
         try:
             # 添加-y参数自动覆盖已存在的文件，无需用户确认
             # 不捕获输出，让ffmpeg的输出直接显示在终端中
-            subprocess.run(
-                [ffmpeg_path, '-y', '-f', 'concat', '-safe', '0', '-i', file_list_path, '-c', 'copy', output_path],
-                check=True
+            process = subprocess.Popen(
+                [ffmpeg_path, '-y', '-f', 'mpegts', '-i', 'pipe:0', '-c', 'copy', output_path],
+                stdin=subprocess.PIPE,
+                bufsize=0
             )
+            try:
+                self._write_segments_to(process.stdin)
+            except BrokenPipeError:
+                # ffmpeg提前退出，由下面的返回码判断是否失败
+                pass
+            finally:
+                try:
+                    process.stdin.close()
+                except BrokenPipeError:
+                    pass
+            if process.wait() != 0:
+                raise subprocess.CalledProcessError(process.returncode, ffmpeg_path)
             print("视频合并成功")
+            self._mark_completed(output_path)
             return True
         except subprocess.CalledProcessError:
             print("视频合并失败")
             return False
 
+    def _mark_completed(self, output_path):
+        """所有片段都下载成功时记录输出文件，下次运行同一URL可直接跳过"""
+        if self.fail_count > 0:
+            return
+        try:
+            record = {
+                'url': self.m3u8_url,
+                'output_path': os.path.abspath(output_path),
+                'size': os.path.getsize(output_path)
+            }
+            with open(os.path.join(self.temp_dir, COMPLETED_FILE_NAME), 'w', encoding='utf-8') as f:
+                json.dump(record, f, ensure_ascii=False, indent=2)
+        except Exception as e:
+            print(f"记录下载完成信息失败: {e}")
+
+    def find_completed_output(self):
+        """返回之前已完整下载的输出文件路径，文件不存在或大小不符时返回None"""
+        completed_file = os.path.join(self.temp_dir, COMPLETED_FILE_NAME)
+        if not os.path.exists(completed_file):
+            return None
+        try:
+            with open(completed_file, 'r', encoding='utf-8') as f:
+                record = json.load(f)
+            output_path = record.get('output_path')
+            if (record.get('url') == self.m3u8_url and output_path and os.path.exists(output_path)
+                    and os.path.getsize(output_path) == record.get('size')):
+                return output_path
+        except Exception as e:
+            print(f"读取下载完成信息失败: {e}")
+        return None
+
+    def _concat_segments_ts(self, output_path):
+        """不经过ffmpeg，按顺序把所有TS片段直接拼接成一个TS文件"""
+        with open(output_path, 'wb', buffering=0) as out:
+            self._write_segments_to(out)
+
+    def _write_segments_to(self, out):
+        """按顺序把已下载的TS片段写入out（无缓冲的文件或管道）"""
+        segment_sizes = self._scan_segment_files()
+        for i in range(len(self.segments)):
+            size = segment_sizes.get(i)
+            if not size:
+                continue
+            with open(self._segment_paths[i], 'rb') as src:
+                # 提示内核顺序读取，读完后释放页缓存，批量合并时不挤占内存
+                _fadvise(src, 'POSIX_FADV_SEQUENTIAL')
+                _append_file(src, out, size)
+                _fadvise(src, 'POSIX_FADV_DONTNEED')
+
     def _load_download_state(self):
         """加载之前的下载状态"""
         if os.path.exists(self.state_file):
             try:
-                with open(self.state_file, 'r', encoding='utf-8') as f:
-                    state = json.load(f)
-                    self.downloaded_segments = set(state.get('downloaded_segments', []))
+                with open(self.state_file, 'rb') as f:
+                    data = f.read()
+                    state = orjson.loads(data) if orjson is not None else json.loads(data)
+                    if 'downloaded_bitmap' in state:
+                        self.downloaded_segments = _decode_bitmap(state['downloaded_bitmap'])
+                    else:
+                        # 兼容旧版本以列表保存的状态文件
+                        self.downloaded_segments = set(state.get('downloaded_segments', []))
                     self.failed_segments = set(state.get('failed_segments', []))
                     
-                    # 检查哪些已下载的文件可能丢失了
-                    current_downloaded = set()
-                    for i in self.downloaded_segments:
-                        segment_path = os.path.join(self.temp_dir, f"segment_{i:05d}.ts")
-                        if os.path.exists(segment_path) and os.path.getsize(segment_path) > 0:
-                            current_downloaded.add(i)
-                        else:
-                            # 文件已丢失，需要重新下载
-                            self.failed_segments.add(i)
-                    
-                    self.downloaded_segments = current_downloaded
+                    # 检查哪些已下载的文件可能丢失了，丢失的需要重新下载
+                    present = {i for i, size in self._scan_segment_files().items() if size > 0}
+                    self.failed_segments |= self.downloaded_segments - present
+                    self.downloaded_segments &= present
                     print(f"加载下载状态成功: 已下载 {len(self.downloaded_segments)} 个片段，失败 {len(self.failed_segments)} 个片段")
             except Exception as e:
                 print(f"加载下载状态失败: {e}")
@@ -442,33 +1110,56 @@ class M3U8Downloader:
                 self.failed_segments = set()
     
     def _save_download_state(self):
-        """保存当前的下载状态"""
+        """保存当前的下载状态，状态没有变化时跳过"""
+        if not self._state_dirty:
+            return
         try:
+            with self._state_lock:
+                downloaded_segments = set(self.downloaded_segments)
+                failed_segments = list(self.failed_segments)
+                self._state_dirty = False
+            # 已下载片段通常很多，用位图保存；失败片段一般很少，仍然保存为列表
             state = {
-                'downloaded_segments': list(self.downloaded_segments),
-                'failed_segments': list(self.failed_segments),
+                'downloaded_bitmap': _encode_bitmap(downloaded_segments),
+                'failed_segments': failed_segments,
                 'last_update_time': time.time()
             }
-            with open(self.state_file, 'w', encoding='utf-8') as f:
-                json.dump(state, f, ensure_ascii=False, indent=2)
+            # 状态文件只给程序读取，使用紧凑格式
+            if orjson is not None:
+                data = orjson.dumps(state)
+            else:
+                data = json.dumps(state, separators=(',', ':')).encode('utf-8')
+            # 先写临时文件再重命名，避免中断时留下不完整的状态文件
+            temp_file = self.state_file + '.tmp'
+            with open(temp_file, 'wb') as f:
+                f.write(data)
+            os.replace(temp_file, self.state_file)
         except Exception as e:
             print(f"保存下载状态失败: {e}")
     
+    def close(self):
+        """关闭会话和连接池，释放所有长连接（共用的连接池由批量下载器负责关闭）"""
+        if self._key_executor is not None:
+            self._key_executor.shutdown(wait=False, cancel_futures=True)
+            self._key_executor = None
+        if self._shared_pool is not None:
+            return
+        self.session.close()
+        if self.http is not None:
+            self.http.clear()
+
     def cleanup(self):
         # 删除临时文件，但保留最终视频
         try:
-            for i in range(len(self.segments)):
-                segment_path = os.path.join(self.temp_dir, f"segment_{i:05d}.ts")
-                if os.path.exists(segment_path):
-                    os.remove(segment_path)
-            
-            file_list_path = os.path.join(self.temp_dir, FILE_LIST_NAME)
-            if os.path.exists(file_list_path):
-                os.remove(file_list_path)
+            for segment_path in self._segment_paths:
+                for path in (segment_path, segment_path + '.part'):
+                    if os.path.exists(path):
+                        os.remove(path)
             
-            # 清理下载状态文件
-            if os.path.exists(self.state_file):
-                os.remove(self.state_file)
+            # 清理下载状态文件和缓存的m3u8文件
+            for path in (self.state_file, self.playlist_file):
+                if os.path.exists(path):
+                    os.remove(path)
             
             print("临时文件清理完成")
         except Exception as e:
@@ -480,7 +1171,7 @@ class BatchM3U8Downloader:
     支持处理Chrome扩展导出的JSON文件，实现批量下载和并行处理
     """
     
-    def __init__(self, json_file_path, max_concurrent_videos=3, max_workers_per_video=10, output_base_dir=None, custom_headers=None):
+    def __init__(self, json_file_path, max_concurrent_videos=3, max_workers_per_video=10, output_base_dir=None, custom_headers=None, limit_conn_per_host=0):
         """
         初始化批量下载器
         
@@ -490,11 +1181,17 @@ class BatchM3U8Downloader:
             max_workers_per_video: 每个视频的最大线程数
             output_base_dir: 输出目录，默认为当前目录下的downloads文件夹
             custom_headers: 自定义请求头
+            limit_conn_per_host: 所有视频合计对同一主机的最大连接数，0表示不限制
         """
         self.json_file_path = json_file_path
         self.max_concurrent_videos = max_concurrent_videos
         self.max_workers_per_video = max_workers_per_video
         self.custom_headers = custom_headers or {}
+        self.conn_limiter = HostConnectionLimiter(limit_conn_per_host)
+        self.segment_executor = None  # 所有视频共用的片段下载线程池，开始批量下载时创建
+        self.report_thread = None  # 后台保存下载报告的线程
+        self.report_message = ''   # 报告保存结果，由汇总输出统一打印
+        self.connection_pool = SharedConnectionPool(max_concurrent_videos * max_workers_per_video)
         self.video_list = []
         self.download_results = []
         self.start_time = None
@@ -506,8 +1203,7 @@ class BatchM3U8Downloader:
         else:
             self.output_base_dir = output_base_dir
             
-        if not os.path.exists(self.output_base_dir):
-            os.makedirs(self.output_base_dir)
+        os.makedirs(self.output_base_dir, exist_ok=True)
             
         # 状态统计
         self.total_videos = 0
@@ -519,6 +1215,7 @@ class BatchM3U8Downloader:
         print(f"输出目录: {self.output_base_dir}")
         print(f"最大并发视频数: {max_concurrent_videos}")
         print(f"每个视频的最大线程数: {max_workers_per_video}")
+        print(f"每个主机的最大连接数: {limit_conn_per_host or '不限制'}")
     
     def load_json_file(self):
         """
@@ -529,8 +1226,9 @@ class BatchM3U8Downloader:
                 print(f"错误: JSON文件不存在: {self.json_file_path}")
                 return False
                 
-            with open(self.json_file_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
+            with open(self.json_file_path, 'rb') as f:
+                raw = f.read()
+            data = orjson.loads(raw) if orjson is not None else json.loads(raw)
             
             # 解析JSON数据结构
             if 'links' in data and isinstance(data['links'], list):
@@ -542,6 +1240,15 @@ class BatchM3U8Downloader:
                 print("错误: JSON文件格式不正确")
                 return False
             
+            # 加载时一次性校验所有条目，格式不正确的条目直接丢弃，避免下载时才出错
+            valid_list = [v for v in self.video_list if self._is_valid_entry(v)]
+            if len(valid_list) < len(self.video_list):
+                print(f"已忽略 {len(self.video_list) - len(valid_list)} 个格式不正确的条目")
+            self.video_list = valid_list
+            
+            # 按主机分组排序（保持同一主机内的原有顺序），同一CDN的视频连续下载，便于复用连接
+            self.video_list.sort(key=self._video_host)
+            
             self.total_videos = len(self.video_list)
             print(f"成功加载 {self.total_videos} 个M3U8链接")
             
@@ -563,7 +1270,25 @@ class BatchM3U8Downloader:
             print(f"错误: 读取JSON文件失败: {e}")
             return False
     
-    def _create_enhanced_downloader(self, video_info):
+    @staticmethod
+    def _is_valid_entry(video_info):
+        """检查JSON中的单个条目：字符串URL，或包含url字段、headers/securityHeaders为字典的对象"""
+        if isinstance(video_info, str):
+            return bool(video_info.strip())
+        if not isinstance(video_info, dict):
+            return False
+        url = video_info.get('url')
+        return (isinstance(url, str) and bool(url.strip())
+                and isinstance(video_info.get('headers', {}), dict)
+                and isinstance(video_info.get('securityHeaders', {}), dict))
+    
+    @staticmethod
+    def _video_host(video_info):
+        """获取视频链接所在的主机"""
+        url = video_info.get('url', '') if isinstance(video_info, dict) else str(video_info)
+        return urlparse(url).netloc
+    
+    def _create_enhanced_downloader(self, video_info, dry_run=False):
         """
         根据Chrome扩展提供的信息创建增强的下载器实例
         """
@@ -598,7 +1323,11 @@ class BatchM3U8Downloader:
                 max_workers=self.max_workers_per_video,
                 max_retries=3,
                 retry_delay=2,
-                custom_headers=enhanced_headers
+                custom_headers=enhanced_headers,
+                conn_limiter=self.conn_limiter,
+                executor=self.segment_executor,
+                connection_pool=self.connection_pool,
+                dry_run=dry_run
             )
             
             return downloader
@@ -607,7 +1336,11 @@ class BatchM3U8Downloader:
             return M3U8Downloader(
                 m3u8_url=str(video_info),
                 max_workers=self.max_workers_per_video,
-                custom_headers=self.custom_headers
+                custom_headers=self.custom_headers,
+                conn_limiter=self.conn_limiter,
+                executor=self.segment_executor,
+                connection_pool=self.connection_pool,
+                dry_run=dry_run
             )
     
     def _download_single_video(self, video_info, index):
@@ -628,6 +1361,7 @@ class BatchM3U8Downloader:
             'end_time': None,
             'duration': 0
         }
+        downloader = None
         
         try:
             result['start_time'] = time.time()
@@ -636,6 +1370,12 @@ class BatchM3U8Downloader:
                 print(f"\n[{index+1}/{self.total_videos}] 开始下载: {domain}")
                 print(f"URL: {url[:80]}...")
             
+            # 已请求停止时不再开始新的视频
+            if _STOP.is_set():
+                result['status'] = 'failed'
+                result['error'] = '用户中断'
+                return result
+            
             # 创建增强的下载器
             downloader = self._create_enhanced_downloader(video_info)
             
@@ -675,11 +1415,41 @@ class BatchM3U8Downloader:
                 print(f"错误: {result['error']}")
         
         finally:
+            if downloader is not None:
+                downloader.close()
             result['end_time'] = time.time()
             result['duration'] = result['end_time'] - result['start_time'] if result['start_time'] else 0
         
         return result
     
+    def dry_run(self):
+        """只解析每个视频的m3u8并估算大小，不下载片段"""
+        def inspect(video_info):
+            downloader = self._create_enhanced_downloader(video_info, dry_run=True)
+            try:
+                if not downloader._download_m3u8():
+                    return None, None
+                return len(downloader.segments), downloader.estimate_size()
+            finally:
+                downloader.close()
+        
+        total_segments = 0
+        total_size = 0
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_videos) as executor:
+            results = executor.map(inspect, self.video_list)
+            for i, (video_info, (count, size)) in enumerate(zip(self.video_list, results)):
+                domain = video_info.get('domain', 'Unknown') if isinstance(video_info, dict) else self._video_host(video_info)
+                if count is None:
+                    print(f"  {i+1}. {domain} - 解析失败")
+                    continue
+                total_segments += count
+                total_size += size or 0
+                size_text = f"{size/1024/1024:.1f} MB" if size else "未知"
+                print(f"  {i+1}. {domain} - {count} 个片段，预计大小 {size_text}")
+        self.connection_pool.close()
+        
+        print(f"\n共 {self.total_videos} 个视频，{total_segments} 个片段，预计总大小 {total_size/1024/1024:.1f} MB")
+    
     def start_batch_download(self, skip_existing=True):
         """
         开始批量下载
@@ -698,8 +1468,11 @@ class BatchM3U8Downloader:
         
         self.start_time = time.time()
         
+        # 所有视频的片段共用一个线程池，总线程数与之前各视频分别创建线程池时的上限相同
+        self.segment_executor = ThreadPoolExecutor(max_workers=self.max_concurrent_videos * self.max_workers_per_video)
+        
         # 使用线程池执行并发下载
-        with ThreadPoolExecutor(max_workers=self.max_concurrent_videos) as executor:
+        with self.segment_executor, ThreadPoolExecutor(max_workers=self.max_concurrent_videos) as executor:
             # 提交所有下载任务
             future_to_video = {
                 executor.submit(self._download_single_video, video_info, i): (video_info, i)
@@ -707,6 +1480,7 @@ class BatchM3U8Downloader:
             }
             
             # 等待任务完成并收集结果
+            completed = 0  # 已结束（成功或失败）的视频数，逐个累加，不再每次扫描全部结果
             for future in as_completed(future_to_video):
                 video_info, index = future_to_video[future]
                 try:
@@ -714,15 +1488,19 @@ class BatchM3U8Downloader:
                     self.download_results.append(result)
                     
                     # 显示进度
-                    completed = len([r for r in self.download_results if r['status'] in ['completed', 'failed']])
+                    if result['status'] in ('completed', 'failed'):
+                        completed += 1
                     progress = (completed / self.total_videos) * 100
                     
+                    # 先拼好要输出的内容，持有锁期间只做一次输出
+                    message = (f"\n总进度: {progress:.1f}% ({completed}/{self.total_videos})\n"
+                               f"成功: {self.completed_videos} | 失败: {self.failed_videos}")
                     with self.lock:
-                        print(f"\n总进度: {progress:.1f}% ({completed}/{self.total_videos})")
-                        print(f"成功: {self.completed_videos} | 失败: {self.failed_videos}")
+                        print(message)
                         
                 except Exception as e:
                     print(f"处理下载任务时出错: {e}")
+        self.connection_pool.close()
         
         # 显示最终结果
         self._show_final_results()
@@ -735,78 +1513,111 @@ class BatchM3U8Downloader:
         end_time = time.time()
         total_duration = end_time - self.start_time if self.start_time else 0
         
-        print("\n" + "=" * 80)
-        print("批量下载完成!")
-        print("=" * 80)
+        # 在后台线程中保存下载报告，与下面整理统计结果同时进行
+        self.report_thread = threading.Thread(target=self._save_download_report, args=(total_duration,), name='report-writer')
+        self.report_thread.start()
         
-        print(f"总视频数: {self.total_videos}")
-        print(f"成功下载: {self.completed_videos}")
-        print(f"下载失败: {self.failed_videos}")
-        print(f"总耗时: {total_duration:.1f} 秒")
+        # 所有输出先拼成一段文本，最后一次性写入标准输出
+        lines = [
+            "\n" + "=" * 80,
+            "批量下载完成!",
+            "=" * 80,
+            f"总视频数: {self.total_videos}",
+            f"成功下载: {self.completed_videos}",
+            f"下载失败: {self.failed_videos}",
+            f"总耗时: {total_duration:.1f} 秒",
+        ]
         
         if self.completed_videos > 0:
             avg_time = total_duration / self.completed_videos
-            print(f"平均每个视频: {avg_time:.1f} 秒")
+            lines.append(f"平均每个视频: {avg_time:.1f} 秒")
+        
+        # 一次遍历把结果分成失败和成功两组
+        failed_results = []
+        success_results = []
+        for result in self.download_results:
+            if result['status'] == 'failed':
+                failed_results.append(result)
+            elif result['status'] == 'completed':
+                success_results.append(result)
         
         # 显示失败的视频详情
-        failed_results = [r for r in self.download_results if r['status'] == 'failed']
         if failed_results:
-            print(f"\n失败的视频详情:")
-            for result in failed_results:
-                print(f"  ❌ {result['domain']}: {result['error']}")
+            lines.append("\n失败的视频详情:")
+            lines.extend(f"  ❌ {r['domain']}: {r['error']}" for r in failed_results)
         
         # 显示成功的视频路径
-        success_results = [r for r in self.download_results if r['status'] == 'completed']
         if success_results:
-            print(f"\n成功下载的视频:")
-            for result in success_results:
-                print(f"  ✅ {result['domain']}: {result['output_dir']}")
+            lines.append("\n成功下载的视频:")
+            lines.extend(f"  ✅ {r['domain']}: {r['output_dir']}" for r in success_results)
         
-        # 保存下载报告
-        self._save_download_report(total_duration)
+        # 等报告写完再输出，报告线程不直接打印，保存结果随统计信息一起写出，避免输出交错
+        self.report_thread.join()
+        lines.append(self.report_message)
+        
+        sys.stdout.write('\n'.join(lines) + '\n')
+        sys.stdout.flush()
     
     def _save_download_report(self, total_duration):
         """
-        保存下载报告到JSON文件
+        保存下载报告到JSON文件，结果提示保存在report_message中
         """
         try:
-            report = {
-                'timestamp': datetime.now().isoformat(),
-                'total_videos': self.total_videos,
-                'completed_videos': self.completed_videos,
-                'failed_videos': self.failed_videos,
-                'total_duration': total_duration,
-                'average_duration': total_duration / max(self.completed_videos, 1),
-                'settings': {
-                    'max_concurrent_videos': self.max_concurrent_videos,
-                    'max_workers_per_video': self.max_workers_per_video,
-                    'output_base_dir': self.output_base_dir
-                },
-                'results': self.download_results
-            }
+            # 只取一次当前时间，保证报告内的时间戳与文件名一致
+            now = datetime.now()
+            header = _REPORT_HEADER_FMT % (
+                now.isoformat(),
+                self.total_videos,
+                self.completed_videos,
+                self.failed_videos,
+                float(total_duration),
+                total_duration / max(self.completed_videos, 1),
+                self.max_concurrent_videos,
+                self.max_workers_per_video,
+                _JSON_ENCODER.encode(self.output_base_dir)
+            )
             
-            report_file = os.path.join(self.output_base_dir, f'download_report_{datetime.now().strftime("%Y%m%d_%H%M%S")}.json')
-            with open(report_file, 'w', encoding='utf-8') as f:
-                json.dump(report, f, ensure_ascii=False, indent=2)
+            report_file = os.path.join(self.output_base_dir, f'download_report_{now.strftime("%Y%m%d_%H%M%S")}.json')
+            with open(report_file, 'wb', buffering=1 << 20) as f:
+                # 先写报告头部，再逐条写入下载结果，不在内存中拼出整个报告
+                f.write(header.encode('utf-8'))
+                for i, result in enumerate(self.download_results):
+                    if i:
+                        f.write(b',')
+                    f.write(_json_bytes(result))
+                f.write(b']}')
             
-            print(f"\n下载报告已保存: {report_file}")
+            self.report_message = f"\n下载报告已保存: {report_file}"
             
         except Exception as e:
-            print(f"保存下载报告失败: {e}")
+            self.report_message = f"\n保存下载报告失败: {e}"
 
-def parse_args():
-    """解析命令行参数"""
-    import argparse
+def _prompt_or_exit(message, missing):
+    """交互式读取输入；标准输入不是终端时直接退出，避免在自动化环境中一直阻塞"""
+    if not sys.stdin.isatty():
+        logger.error(f"错误: 未指定{missing}，且当前不是交互式终端")
+        sys.exit(2)
+    return input(message).strip()
+
+@functools.lru_cache(maxsize=1)
+def _build_parser():
+    """创建命令行参数解析器（只创建一次）"""
     parser = argparse.ArgumentParser(description='M3U8视频下载器')
     parser.add_argument('url', nargs='?', help='M3U8文件的网址')
     parser.add_argument('--batch', help='批量下载模式，指定JSON文件路径')
     parser.add_argument('--keep-segments', action='store_true', help='保留原始视频切片文件')
     parser.add_argument('--abort-on-error', action='store_true', help='当有片段下载失败时终止程序')
+    parser.add_argument('--dry-run', action='store_true', help='只解析m3u8并显示片段数量和预计大小，不下载')
+    parser.add_argument('--force', action='store_true', help='即使之前已完整下载过也重新下载')
     parser.add_argument('--test-mode', action='store_true', help='启用测试模式（模拟部分片段下载失败）')
     parser.add_argument('--max-concurrent', type=int, default=DEFAULT_DOWNLOAD_CONFIG['max_concurrent_videos'], 
                         help='同时下载的视频数量')
     parser.add_argument('--max-workers', type=int, default=DEFAULT_DOWNLOAD_CONFIG['max_workers_per_video'], 
                         help='每个视频的最大线程数')
+    parser.add_argument('--limit-conn-per-host', type=int, default=0,
+                        help='同一主机的最大并发连接数（批量下载时所有视频合计），默认0表示不限制')
+    parser.add_argument('--auto-workers', action='store_true',
+                        help='根据前几个片段的下载耗时自动调整每个视频的线程数')
     parser.add_argument('--max-retries', type=int, default=DEFAULT_DOWNLOAD_CONFIG['max_retries'],
                         help='下载失败时的最大重试次数')
     parser.add_argument('--retry-delay', type=int, default=DEFAULT_DOWNLOAD_CONFIG['retry_delay'],
@@ -816,42 +1627,66 @@ def parse_args():
     parser.add_argument('--referer', type=str, help='自定义Referer')
     parser.add_argument('--output-dir', type=str, default=DEFAULT_OUTPUT_DIR,
                         help='输出目录')
+    verbosity = parser.add_mutually_exclusive_group()
+    verbosity.add_argument('--quiet', action='store_true', help='只输出警告和错误信息')
+    verbosity.add_argument('--verbose', action='store_true', help='输出调试信息')
     
-    return parser.parse_args()
+    return parser
+
+def parse_args():
+    """解析命令行参数"""
+    return _build_parser().parse_args()
+
+def _handle_stop_signal(signum, frame):
+    """第一次收到信号时通知下载线程停止并等待当前片段完成，再次收到时立即中断"""
+    if _STOP.is_set():
+        raise KeyboardInterrupt
+    _STOP.set()
+    logger.warning("\n收到停止信号，正在等待进行中的片段完成（再按一次Ctrl+C立即退出）...")
+
+def _install_signal_handlers():
+    """安装SIGINT/SIGTERM处理函数"""
+    signal.signal(signal.SIGINT, _handle_stop_signal)
+    signal.signal(signal.SIGTERM, _handle_stop_signal)
+
+def _build_custom_headers(args):
+    """根据命令行参数生成自定义请求头"""
+    custom_headers = {}
+    if args.user_agent:
+        custom_headers['User-Agent'] = args.user_agent
+    if args.referer:
+        custom_headers['Referer'] = args.referer
+    return custom_headers
 
 def single_download(args):
     """单个视频下载"""
-    print("=== 单个视频下载模式 ===")
+    logger.info("=== 单个视频下载模式 ===")
     
     # 获取M3U8 URL
     m3u8_url = args.url
     if not m3u8_url:
-        m3u8_url = input("请输入m3u8文件的网址: ").strip()
+        m3u8_url = _prompt_or_exit("请输入m3u8文件的网址: ", "M3U8网址")
     
     if not m3u8_url:
-        print("网址不能为空")
+        logger.error("网址不能为空")
         return
     
     # 显示当前的设置
     if args.keep_segments:
-        print("注意：将保留原始视频切片文件")
+        logger.info("注意：将保留原始视频切片文件")
     else:
-        print("注意：将自动清理临时视频切片文件")
+        logger.info("注意：将自动清理临时视频切片文件")
     
     if args.abort_on_error:
-        print("注意：当有片段下载失败时将终止程序，不进行合并")
+        logger.info("注意：当有片段下载失败时将终止程序，不进行合并")
     else:
-        print("注意：当有片段下载失败时将自动排除失败片段，继续合并")
+        logger.info("注意：当有片段下载失败时将自动排除失败片段，继续合并")
     
     if args.test_mode:
-        print("注意：已启用测试模式，将模拟部分片段下载失败")
+        logger.info("注意：已启用测试模式，将模拟部分片段下载失败")
     
     # 创建自定义请求头
-    custom_headers = {}
-    if args.user_agent:
-        custom_headers['User-Agent'] = args.user_agent
-    if args.referer:
-        custom_headers['Referer'] = args.referer
+    custom_headers = _build_custom_headers(args)
     
     # 创建下载器实例
     downloader = M3U8Downloader(
@@ -860,28 +1695,49 @@ def single_download(args):
         max_retries=args.max_retries,
         retry_delay=args.retry_delay,
         test_mode=args.test_mode,
-        custom_headers=custom_headers
+        custom_headers=custom_headers,
+        auto_workers=args.auto_workers,
+        conn_limiter=HostConnectionLimiter(args.limit_conn_per_host),
+        dry_run=args.dry_run
     )
     
     try:
+        # 同一URL之前已完整下载过且输出文件还在时直接跳过（只解析不下载时不检查）
+        if not args.force and not args.dry_run:
+            existing_output = downloader.find_completed_output()
+            if existing_output:
+                logger.info(f"视频已下载过，跳过: {existing_output}")
+                logger.info("如需重新下载，请使用 --force 参数")
+                return
+        
         # 下载m3u8文件并解析
         if not downloader._download_m3u8():
             return
         
+        # 只解析不下载：显示片段数量和预计大小
+        if args.dry_run:
+            size = downloader.estimate_size()
+            size_text = f"{size/1024/1024:.1f} MB" if size else "未知"
+            logger.info(f"片段数量: {len(downloader.segments)}，预计大小: {size_text}")
+            return
+        
         # 下载所有ts片段
         all_segments_successful = downloader.download_all_segments()
+        if _STOP.is_set():
+            logger.warning("\n程序被用户中断，保留切片文件供下次使用")
+            return
         
         # 如果有片段下载失败
         if not all_segments_successful:
             if args.abort_on_error:
-                print("错误：有片段下载失败，已按照--abort-on-error参数设置终止程序")
+                logger.error("错误：有片段下载失败，已按照--abort-on-error参数设置终止程序")
                 return
             else:
                 # 自动排除失败的片段，继续合并
-                print(f"警告：有 {downloader.fail_count} 个片段下载失败，将只使用成功下载的片段进行合并")
+                logger.warning(f"警告：有 {downloader.fail_count} 个片段下载失败，将只使用成功下载的片段进行合并")
                 # 检查是否还有成功下载的片段
                 if downloader.success_count == 0:
-                    print("错误：没有成功下载的片段，无法进行合并")
+                    logger.error("错误：没有成功下载的片段，无法进行合并")
                     return
                 # 更新下载状态
                 downloader._save_download_state()
@@ -890,48 +1746,47 @@ def single_download(args):
         if downloader.merge_segments(output_dir=args.output_dir):
             # 只有在合并成功后才根据参数决定是否清理临时文件
             if args.keep_segments:
-                print("已保留原始视频切片文件")
+                logger.info("已保留原始视频切片文件")
             else:
                 downloader.cleanup()
             
-            print(f"\n视频下载完成，保存在: {args.output_dir}")
+            logger.info(f"\n视频下载完成，保存在: {args.output_dir}")
         else:
-            print("视频合并失败，保留切片文件供下次使用")
+            logger.warning("视频合并失败，保留切片文件供下次使用")
     except KeyboardInterrupt:
-        print("\n程序被用户中断，保留切片文件供下次使用")
+        logger.warning("\n程序被用户中断，保留切片文件供下次使用")
     except Exception as e:
-        print(f"程序运行出错: {e}")
-        print("保留切片文件供下次使用")
+        logger.error(f"程序运行出错: {e}")
+        logger.info("保留切片文件供下次使用")
+    finally:
+        downloader.close()
 
 def batch_download(args):
     """批量下载"""
-    print("=== 批量下载模式 ===")
+    logger.info("=== 批量下载模式 ===")
     
     json_file = args.batch
     if not json_file:
-        json_file = input("请输入Chrome扩展导出的JSON文件路径: ").strip()
+        json_file = _prompt_or_exit("请输入Chrome扩展导出的JSON文件路径: ", "JSON文件路径")
     
     if not json_file:
-        print("错误：JSON文件路径不能为空")
+        logger.error("错误：JSON文件路径不能为空")
         return
     
-    print(f"JSON文件: {json_file}")
-    print(f"最大并发视频数: {args.max_concurrent}")
-    print(f"每个视频最大线程数: {args.max_workers}")
-    print(f"最大重试次数: {args.max_retries}")
-    print(f"重试间隔: {args.retry_delay}秒")
+    logger.info(f"JSON文件: {json_file}")
+    logger.info(f"最大并发视频数: {args.max_concurrent}")
+    logger.info(f"每个视频最大线程数: {args.max_workers}")
+    logger.info(f"每个主机最大连接数: {args.limit_conn_per_host or '不限制'}")
+    logger.info(f"最大重试次数: {args.max_retries}")
+    logger.info(f"重试间隔: {args.retry_delay}秒")
     
     if args.keep_segments:
-        print("注意：将保留原始视频切片文件")
+        logger.info("注意：将保留原始视频切片文件")
     if args.abort_on_error:
-        print("注意：当有片段下载失败时将终止程序")
+        logger.info("注意：当有片段下载失败时将终止程序")
     
     # 创建自定义请求头
-    custom_headers = {}
-    if args.user_agent:
-        custom_headers['User-Agent'] = args.user_agent
-    if args.referer:
-        custom_headers['Referer'] = args.referer
+    custom_headers = _build_custom_headers(args)
     
     # 创建批量下载器
     batch_downloader = BatchM3U8Downloader(
@@ -939,7 +1794,8 @@ def batch_download(args):
         max_concurrent_videos=args.max_concurrent,
         max_workers_per_video=args.max_workers,
         output_base_dir=args.output_dir,
-        custom_headers=custom_headers
+        custom_headers=custom_headers,
+        limit_conn_per_host=args.limit_conn_per_host
     )
     
     try:
@@ -947,22 +1803,37 @@ def batch_download(args):
         if not batch_downloader.load_json_file():
             return
         
+        # 只解析不下载
+        if args.dry_run:
+            batch_downloader.dry_run()
+            return
+        
         # 开始批量下载
         batch_downloader.start_batch_download()
         
     except KeyboardInterrupt:
-        print("\n程序被用户中断")
+        logger.warning("\n程序被用户中断")
     except Exception as e:
-        print(f"批量下载出错: {e}")
+        logger.error(f"批量下载出错: {e}")
 
 def main():
-    print("欢迎使用M3U8视频下载器")
-    print("支持单个视频下载和Chrome扩展JSON文件批量下载")
-    print("注意：本程序需要ffmpeg支持，请确保已安装并添加到环境变量")
-    
     # 解析命令行参数
     args = parse_args()
     
+    # 配置日志输出级别
+    if args.quiet:
+        level = logging.WARNING
+    elif args.verbose:
+        level = logging.DEBUG
+    else:
+        level = logging.INFO
+    logging.basicConfig(level=level, handlers=[logging.StreamHandler(sys.stdout)], format='%(message)s')
+    _install_signal_handlers()
+    
+    logger.info("欢迎使用M3U8视频下载器")
+    logger.info("支持单个视频下载和Chrome扩展JSON文件批量下载")
+    logger.info("注意：本程序需要ffmpeg支持，请确保已安装并添加到环境变量")
+    
     # 批量下载模式
     if args.batch:
         batch_download(args)
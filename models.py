@@ -5,9 +5,9 @@ from dataclasses import dataclass
 from typing import Optional, Dict, Any
 from urllib.parse import urlparse
 
-@dataclass
+@dataclass(slots=True)
 class DownloadResult:
-    """下载结果数据类"""
+    """下载结果数据类（批量下载时数量较多，使用__slots__减少内存占用；slots参数需要Python 3.10及以上）"""
     index: int
     url: str
     domain: str
@@ -22,6 +22,20 @@ class DownloadResult:
         if not self.domain and self.url:
             self.domain = urlparse(self.url).netloc
 
+    def to_dict(self) -> Dict[str, Any]:
+        """转换为用于下载报告的字典"""
+        return {
+            'index': self.index,
+            'url': self.url,
+            'domain': self.domain,
+            'status': self.status,
+            'error': self.error,
+            'output_dir': self.output_dir,
+            'start_time': self.start_time,
+            'end_time': self.end_time,
+            'duration': self.duration
+        }
+
 @dataclass
 class VideoInfo:
     """视频信息数据类"""
@@ -29,7 +43,24 @@ class VideoInfo:
     domain: str = "Unknown"
     headers: Optional[Dict[str, Any]] = None
     security_headers: Optional[Dict[str, Any]] = None
+    host: str = ""
 
     def __post_init__(self):
+        # 只解析一次URL，后续按主机分组、限速等直接使用host
+        if not self.host and self.url:
+            self.host = urlparse(self.url).netloc
         if not self.domain and self.url:
-            self.domain = urlparse(self.url).netloc
\ No newline at end of file
+            self.domain = self.host
+
+    @classmethod
+    def from_entry(cls, entry):
+        """从批量下载JSON中的一条记录创建视频信息"""
+        if isinstance(entry, dict):
+            return cls(
+                url=entry.get('url', ''),
+                domain=entry.get('domain', 'Unknown'),
+                headers=entry.get('headers'),
+                security_headers=entry.get('securityHeaders')
+            )
+        url = str(entry)
+        return cls(url=url, domain=urlparse(url).netloc)
\ No newline at end of file
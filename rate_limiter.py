@@ -0,0 +1,79 @@
+"""
+流量控制模块
+"""
+import threading
+import time
+from collections import deque
+
+class AIMDConcurrencyLimiter:
+    """基于AIMD（加性增、乘性减）的并发控制器"""
+
+    def __init__(self, initial_limit, min_limit=1, max_limit=None, target_latency=2.0, window=8):
+        self.min_limit = min_limit
+        self.max_limit = max_limit or initial_limit * 4
+        self.limit = max(min_limit, min(initial_limit, self.max_limit))
+        self.target_latency = target_latency
+        self.window = window
+
+        self.in_flight = 0
+        self.latencies = {}  # 每个主机最近若干个视频的平均请求耗时
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        """获取一个并发许可，超过当前并发上限时阻塞"""
+        with self.cond:
+            while self.in_flight >= self.limit:
+                self.cond.wait()
+            self.in_flight += 1
+
+    def release(self, host, latency=None, overloaded=False):
+        """归还并发许可，并根据任务结果调整并发上限
+        
+        latency为该视频各请求的平均耗时（没有发出请求时为None），
+        overloaded表示遇到了服务器过载的信号（429、5xx、连接超时等）
+        """
+        with self.cond:
+            self.in_flight -= 1
+            if overloaded:
+                # 服务器过载时乘性减少并发；链接失效、解析失败等其他错误不影响并发数
+                self.limit = max(self.limit // 2, self.min_limit)
+            elif latency is not None:
+                latencies = self.latencies.setdefault(host, deque(maxlen=self.window))
+                latencies.append(latency)
+                # 平均请求耗时未超过目标值时加性增加并发
+                if sum(latencies) / len(latencies) <= self.target_latency:
+                    self.limit = min(self.limit + 1, self.max_limit)
+            self.cond.notify_all()
+
+class HostRateLimiter:
+    """按主机限制每分钟请求数的滑动窗口限速器"""
+
+    def __init__(self, rpm=0):
+        self.rpm = rpm  # 每个主机每分钟的最大请求数，0表示不限速（仍会遵守429的Retry-After）
+        self.timestamps = {}      # 每个主机最近rpm次请求的时间戳
+        self.blocked_until = {}   # 服务器要求暂停（Retry-After）的截止时间
+        self.lock = threading.Lock()
+
+    def wait_if_throttled(self, host):
+        """在发起请求前调用，超出限速或服务器要求暂停时阻塞直到可以发起请求"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                wait = self.blocked_until.get(host, 0) - now
+                if not self.rpm:
+                    if wait <= 0:
+                        return
+                else:
+                    timestamps = self.timestamps.setdefault(host, deque(maxlen=self.rpm))
+                    if wait <= 0 and len(timestamps) == self.rpm:
+                        wait = 60 - (now - timestamps[0])
+                    if wait <= 0:
+                        timestamps.append(now)
+                        return
+            time.sleep(wait)
+
+    def defer(self, host, seconds):
+        """服务器返回429时，在指定秒数内暂停该主机的所有请求"""
+        with self.lock:
+            until = time.monotonic() + seconds
+            self.blocked_until[host] = max(self.blocked_until.get(host, 0), until)
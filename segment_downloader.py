@@ -5,19 +5,20 @@ import os
 import re
 import sys
 import time
+import threading
 import requests
 from concurrent.futures import ThreadPoolExecutor
-from urllib.parse import urljoin
+from urllib.parse import urljoin, urlparse
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.backends import default_backend
 
-from config import DEFAULT_HEADERS, DEFAULT_OUTPUT_DIR
-from utils import ensure_complete_url, save_download_state
+from config import DEFAULT_HEADERS, DEFAULT_OUTPUT_DIR, MANIFEST_FILE_NAME
+from utils import ensure_complete_url, save_download_state, load_manifest_cache, save_manifest_cache
 
 class SegmentDownloader:
     """片段下载器类"""
     
-    def __init__(self, m3u8_url, max_workers=10, max_retries=3, retry_delay=2, test_mode=False, custom_headers=None, output_dir=None):
+    def __init__(self, m3u8_url, max_workers=10, max_retries=3, retry_delay=2, test_mode=False, custom_headers=None, output_dir=None, session=None, rate_limiter=None):
         self.m3u8_url = m3u8_url
         self.max_workers = max_workers
         self.max_retries = max_retries
@@ -25,6 +26,10 @@ class SegmentDownloader:
         self.test_mode = test_mode
         self.custom_headers = custom_headers or {}
         self.output_dir = output_dir or DEFAULT_OUTPUT_DIR  # 添加output_dir参数
+        # 复用HTTP连接池，批量下载时由BatchDownloader按主机共享传入
+        self.session = session if session is not None else requests.Session()
+        # 按主机限速，批量下载时由BatchDownloader共享传入
+        self.rate_limiter = rate_limiter
         
         # 解析URL信息
         from utils import create_temp_dir, get_base_url
@@ -39,6 +44,12 @@ class SegmentDownloader:
         self.retry_count = 0
         self.start_time = None
         
+        # 请求统计，批量下载时用于调整并发视频数
+        self._stats_lock = threading.Lock()
+        self.request_count = 0
+        self.request_time = 0.0
+        self.overload_count = 0  # 遇到429、5xx或连接超时的次数
+        
         # 解密相关属性
         self.is_encrypted = False
         self.key_url = None
@@ -51,6 +62,9 @@ class SegmentDownloader:
         self.downloaded_segments = set()
         self.failed_segments = set()
         self._load_download_state()
+        
+        # M3U8内容缓存
+        self.manifest_file = os.path.join(self.temp_dir, MANIFEST_FILE_NAME)
     
     def _load_download_state(self):
         """加载下载状态"""
@@ -61,6 +75,29 @@ class SegmentDownloader:
         """保存下载状态"""
         save_download_state(self.state_file, self.downloaded_segments, self.failed_segments)
     
+    def _record_request(self, latency=None, overloaded=False):
+        """记录一次请求的耗时以及是否遇到服务器过载"""
+        with self._stats_lock:
+            if latency is not None:
+                self.request_count += 1
+                self.request_time += latency
+            if overloaded:
+                self.overload_count += 1
+    
+    def _record_response(self, response, latency):
+        """根据响应状态码记录请求结果"""
+        self._record_request(latency, response.status_code == 429 or response.status_code >= 500)
+    
+    def _record_error(self, error):
+        """连接失败或超时也视为服务器过载"""
+        if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+            self._record_request(overloaded=True)
+    
+    def average_latency(self):
+        """返回平均请求耗时（秒），没有完成过请求时返回None"""
+        with self._stats_lock:
+            return self.request_time / self.request_count if self.request_count else None
+    
     def _get_headers(self):
         """获取请求头"""
         headers = DEFAULT_HEADERS.copy()
@@ -68,14 +105,40 @@ class SegmentDownloader:
         headers['Referer'] = self.base_url
         return headers
     
+    def _save_manifest_cache(self, m3u8_content, response):
+        """缓存M3U8内容及用于条件请求的响应头（密钥不写入缓存）"""
+        save_manifest_cache(self.manifest_file, {
+            'url': self.m3u8_url,
+            'playlist': m3u8_content,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified')
+        })
+    
     def download_m3u8(self):
         """下载并解析M3U8文件"""
         try:
             headers = self._get_headers()
             
-            response = requests.get(self.m3u8_url, headers=headers, timeout=30)
-            response.raise_for_status()
-            m3u8_content = response.text
+            # 有缓存时发送条件请求，服务器确认未变化才使用缓存的内容
+            manifest = load_manifest_cache(self.manifest_file)
+            if manifest and manifest.get('url') == self.m3u8_url and manifest.get('playlist'):
+                if manifest.get('etag'):
+                    headers['If-None-Match'] = manifest['etag']
+                if manifest.get('last_modified'):
+                    headers['If-Modified-Since'] = manifest['last_modified']
+            else:
+                manifest = None
+            
+            request_start = time.time()
+            response = self.session.get(self.m3u8_url, headers=headers, timeout=30)
+            self._record_response(response, time.time() - request_start)
+            if response.status_code == 304 and manifest:
+                print("M3U8文件未变化，使用缓存的内容")
+                m3u8_content = manifest['playlist']
+            else:
+                response.raise_for_status()
+                m3u8_content = response.text
+                self._save_manifest_cache(m3u8_content, response)
             
             # 检查是否为加密的m3u8文件
             if '#EXT-X-KEY' in m3u8_content:
@@ -93,7 +156,7 @@ class SegmentDownloader:
                     # 下载密钥
                     print(f"正在下载密钥: {self.key_url}")
                     key_headers = self._get_headers()
-                    key_response = requests.get(self.key_url, headers=key_headers, timeout=30)
+                    key_response = self.session.get(self.key_url, headers=key_headers, timeout=30)
                     key_response.raise_for_status()
                     self.key = key_response.content
                     
@@ -135,6 +198,7 @@ class SegmentDownloader:
             print(f"找到 {len(self.segments)} 个视频片段")
             return True
         except Exception as e:
+            self._record_error(e)
             print(f"下载m3u8文件失败: {e}")
             return False
     
@@ -183,7 +247,14 @@ class SegmentDownloader:
                     time.sleep(self.retry_delay)
                 
                 # 下载片段
-                response = requests.get(segment_url, headers=headers, stream=True, timeout=60)
+                host = urlparse(segment_url).netloc
+                if self.rate_limiter:
+                    self.rate_limiter.wait_if_throttled(host)
+                request_start = time.time()
+                response = self.session.get(segment_url, headers=headers, stream=True, timeout=60)
+                self._record_response(response, time.time() - request_start)
+                if response.status_code == 429:
+                    self._handle_too_many_requests(host, response)
                 response.raise_for_status()
                 
                 # 保存文件
@@ -239,6 +310,7 @@ class SegmentDownloader:
                 sys.stdout.flush()
                 
             except Exception as e:
+                self._record_error(e)
                 last_error = e
                 retries += 1
         
@@ -254,6 +326,15 @@ class SegmentDownloader:
         # 保存下载状态
         self._save_download_state()
     
+    def _handle_too_many_requests(self, host, response):
+        """处理429响应，按Retry-After暂停该主机的请求"""
+        retry_after = response.headers.get('Retry-After', '')
+        delay = int(retry_after) if retry_after.isdigit() else self.retry_delay
+        if self.rate_limiter:
+            self.rate_limiter.defer(host, delay)
+        else:
+            time.sleep(delay)
+    
     def _get_segment_extension(self, segment_url):
         """获取片段文件的扩展名"""
         # 常见的视频/音频文件扩展名
@@ -336,12 +417,16 @@ class SegmentDownloader:
     def cleanup(self):
         """清理临时文件"""
         try:
-            for i in range(len(self.segments)):
-                # 确定片段文件的扩展名
-                segment_extension = self._get_segment_extension(self.segments[i])
-                segment_path = os.path.join(self.temp_dir, f"segment_{i:05d}.{segment_extension}")
-                if os.path.exists(segment_path):
-                    os.remove(segment_path)
+            # 一次扫描临时目录找出所有片段文件，避免逐个检查文件是否存在
+            with os.scandir(self.temp_dir) as entries:
+                segment_paths = [
+                    entry.path for entry in entries
+                    if entry.name.startswith('segment_') and entry.is_file(follow_symlinks=False)
+                ]
+            
+            # 片段文件数量多时并行删除
+            with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+                list(executor.map(os.remove, segment_paths))
             
             from config import FILE_LIST_NAME
             file_list_path = os.path.join(self.temp_dir, FILE_LIST_NAME)
@@ -352,6 +437,10 @@ class SegmentDownloader:
             if os.path.exists(self.state_file):
                 os.remove(self.state_file)
             
+            # 清理M3U8缓存文件
+            if os.path.exists(self.manifest_file):
+                os.remove(self.manifest_file)
+            
             # 尝试删除临时文件夹（只有当文件夹为空时才会成功）
             try:
                 os.rmdir(self.temp_dir)
@@ -0,0 +1,160 @@
+"""
+m3u8_downloader 断点续传测试
+"""
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import urllib3
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import m3u8_downloader
+from m3u8_downloader import M3U8Downloader
+
+SEGMENT_URL = 'http://example.com/video/seg0.ts'
+SEGMENT_DATA = bytes(range(256)) * 64  # 16KB
+
+
+class FakeResponse:
+    """模拟urllib3的流式响应，可在读取若干字节后模拟连接中断"""
+
+    def __init__(self, status, body, headers, fail_after=None):
+        self.status = status
+        self.headers = headers
+        self._body = body
+        self._pos = 0
+        self._fail_after = fail_after
+
+    def read(self, amt=-1):
+        if self._fail_after is not None and self._pos >= self._fail_after:
+            raise urllib3.exceptions.ProtocolError('Connection broken')
+        end = len(self._body) if amt is None or amt < 0 else self._pos + amt
+        if self._fail_after is not None:
+            end = min(end, self._fail_after)
+        data = self._body[self._pos:end]
+        self._pos += len(data)
+        return data
+
+    def stream(self, amt):
+        while True:
+            data = self.read(amt)
+            if not data:
+                return
+            yield data
+
+    def release_conn(self):
+        pass
+
+
+class ResumeSegmentTest(unittest.TestCase):
+
+    def setUp(self):
+        self._cwd = os.getcwd()
+        self._tmp = tempfile.TemporaryDirectory()
+        os.chdir(self._tmp.name)
+        m3u8_downloader._STOP.clear()
+        self.downloader = M3U8Downloader('http://example.com/video/index.m3u8', max_retries=2, retry_delay=0)
+        self.downloader.segments = [SEGMENT_URL]
+        self.downloader._segment_paths = (os.path.join(self.downloader.temp_dir, 'segment_00000.ts'),)
+
+    def tearDown(self):
+        self.downloader.close()
+        os.chdir(self._cwd)
+        self._tmp.cleanup()
+
+    def test_broken_stream_resumes_with_range_request(self):
+        """连接中途断开后，下一次请求从已收到的字节处续传，并得到完整的片段"""
+        cut = 5000
+        total = len(SEGMENT_DATA)
+        requests_seen = []
+
+        def fake_request(method, url, headers=None, **kwargs):
+            requests_seen.append(dict(headers or {}))
+            if len(requests_seen) == 1:
+                return FakeResponse(200, SEGMENT_DATA, {'Content-Length': str(total)}, fail_after=cut)
+            return FakeResponse(206, SEGMENT_DATA[cut:], {
+                'Content-Length': str(total - cut),
+                'Content-Range': f'bytes {cut}-{total - 1}/{total}',
+            })
+
+        self.downloader.http = mock.Mock(headers={})
+        self.downloader.http.request.side_effect = fake_request
+
+        self.downloader._download_segment(SEGMENT_URL, 0)
+
+        self.assertEqual(len(requests_seen), 2)
+        self.assertNotIn('Range', requests_seen[0])
+        self.assertEqual(requests_seen[1].get('Range'), f'bytes={cut}-')
+        with open(self.downloader._segment_paths[0], 'rb') as f:
+            self.assertEqual(f.read(), SEGMENT_DATA)
+        self.assertFalse(os.path.exists(self.downloader._segment_paths[0] + '.part'))
+        self.assertIn(0, self.downloader.downloaded_segments)
+
+    def test_stale_failed_indices_are_ignored(self):
+        """状态文件中超出当前片段数的失败索引不会导致越界"""
+        with open(os.path.join(self.downloader.temp_dir, 'segment_00005.ts'), 'wb') as f:
+            f.write(b'stale')
+        self.downloader.failed_segments = {0, 5}
+        self.downloader.http = mock.Mock(headers={})
+        self.downloader.http.request.return_value = FakeResponse(
+            200, SEGMENT_DATA, {'Content-Length': str(len(SEGMENT_DATA))})
+
+        self.assertTrue(self.downloader.download_all_segments())
+
+        self.assertEqual(self.downloader.failed_segments, set())
+        with open(self.downloader._segment_paths[0], 'rb') as f:
+            self.assertEqual(f.read(), SEGMENT_DATA)
+
+
+class PlaylistCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self._cwd = os.getcwd()
+        self._tmp = tempfile.TemporaryDirectory()
+        os.chdir(self._tmp.name)
+        self.downloader = M3U8Downloader('http://example.com/video/index.m3u8')
+        self.downloader._save_playlist_cache('#EXTM3U\nseg0.ts\n', mock.Mock(headers={'ETag': '"old"'}))
+        self.segment_path = os.path.join(self.downloader.temp_dir, 'segment_00000.ts')
+        with open(self.segment_path, 'wb') as f:
+            f.write(SEGMENT_DATA)
+        with open(self.segment_path + '.part', 'wb') as f:
+            f.write(SEGMENT_DATA[:100])
+        self.downloader.downloaded_segments = {0}
+        self.downloader._state_dirty = True
+        self.downloader._save_download_state()
+
+    def tearDown(self):
+        self.downloader.close()
+        os.chdir(self._cwd)
+        self._tmp.cleanup()
+
+    def _respond(self, status, text):
+        self.downloader.session = mock.Mock()
+        self.downloader.session.get.return_value = mock.Mock(status_code=status, text=text, headers={'ETag': '"new"'})
+
+    def test_changed_playlist_discards_segments_and_state(self):
+        """服务器返回了不同的m3u8时，之前的片段和下载状态都要丢弃"""
+        self._respond(200, '#EXTM3U\nother0.ts\n')
+
+        self.assertEqual(self.downloader._load_playlist(), '#EXTM3U\nother0.ts\n')
+
+        self.assertFalse(os.path.exists(self.segment_path))
+        self.assertFalse(os.path.exists(self.segment_path + '.part'))
+        self.assertFalse(os.path.exists(self.downloader.state_file))
+        self.assertEqual(self.downloader.downloaded_segments, set())
+
+    def test_not_modified_keeps_segments(self):
+        self._respond(304, '')
+
+        self.assertEqual(self.downloader._load_playlist(), '#EXTM3U\nseg0.ts\n')
+
+        self.assertTrue(os.path.exists(self.segment_path))
+        self.assertTrue(os.path.exists(self.downloader.state_file))
+        self.assertEqual(self.downloader.downloaded_segments, {0})
+
+
+if __name__ == '__main__':
+    unittest.main()
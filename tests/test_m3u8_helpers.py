@@ -0,0 +1,104 @@
+"""
+m3u8_downloader 辅助函数（位图、播放列表解析）测试
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from m3u8_downloader import _decode_bitmap, _encode_bitmap, _parse_key_iv, _parse_key_uri, _select_variant
+
+
+class BitmapTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        indices = {0, 3, 5, 17, 100, 1023}
+        self.assertEqual(_decode_bitmap(_encode_bitmap(indices)), indices)
+
+    def test_empty_set(self):
+        self.assertEqual(_encode_bitmap(set()), '')
+        self.assertEqual(_decode_bitmap(''), set())
+
+    def test_byte_boundaries(self):
+        for indices in ({7}, {8}, {7, 8}, {15, 16}, {0, 7, 8, 15}):
+            with self.subTest(indices=indices):
+                self.assertEqual(_decode_bitmap(_encode_bitmap(indices)), indices)
+        # 第7位仍在第一个字节内，第8位需要第二个字节
+        self.assertEqual(_encode_bitmap({7}), 'AQ==')
+        self.assertEqual(_encode_bitmap({8}), 'AIA=')
+
+    def test_range_of_segments(self):
+        indices = set(range(1000))
+        self.assertEqual(_decode_bitmap(_encode_bitmap(indices)), indices)
+
+
+
+class SelectVariantTest(unittest.TestCase):
+
+    def test_highest_bandwidth_wins(self):
+        content = (
+            '#EXTM3U\n'
+            '#EXT-X-STREAM-INF:BANDWIDTH=800000,RESOLUTION=640x360\n'
+            'low/index.m3u8\n'
+            '#EXT-X-STREAM-INF:PROGRAM-ID=1,BANDWIDTH=2500000,CODECS="avc1.4d401f,mp4a.40.2"\n'
+            'high/index.m3u8\n'
+            '#EXT-X-STREAM-INF:BANDWIDTH=1200000\n'
+            'mid/index.m3u8\n'
+        )
+        self.assertEqual(_select_variant(content), 'high/index.m3u8')
+
+    def test_relative_and_absolute_uris_are_returned_as_is(self):
+        content = (
+            '#EXTM3U\n'
+            '#EXT-X-STREAM-INF:BANDWIDTH=100\n'
+            'http://cdn.example.com/a.m3u8\n'
+            '#EXT-X-STREAM-INF:BANDWIDTH=200\n'
+            '../b/index.m3u8\n'
+        )
+        self.assertEqual(_select_variant(content), '../b/index.m3u8')
+
+    def test_missing_bandwidth_counts_as_zero(self):
+        content = (
+            '#EXTM3U\n'
+            '#EXT-X-STREAM-INF:RESOLUTION=1920x1080\n'
+            'nobw.m3u8\n'
+            '#EXT-X-STREAM-INF:BANDWIDTH=1\n'
+            'withbw.m3u8\n'
+        )
+        self.assertEqual(_select_variant(content), 'withbw.m3u8')
+        self.assertEqual(_select_variant('#EXTM3U\n#EXT-X-STREAM-INF:RESOLUTION=1x1\nonly.m3u8\n'), 'only.m3u8')
+
+    def test_media_playlist_returns_none(self):
+        self.assertIsNone(_select_variant('#EXTM3U\n#EXTINF:10,\nseg0.ts\n'))
+
+
+class KeyLineTest(unittest.TestCase):
+
+    def test_quoted_uri_and_iv(self):
+        line = '#EXT-X-KEY:METHOD=AES-128,URI="https://example.com/key?a=1,b=2",IV=0x000102030405060708090a0b0c0d0e0f'
+        self.assertEqual(_parse_key_uri(line), 'https://example.com/key?a=1,b=2')
+        self.assertEqual(_parse_key_iv(line), '0x000102030405060708090a0b0c0d0e0f')
+
+    def test_attribute_order_and_unquoted_values(self):
+        line = '#EXT-X-KEY:IV="0x0f",URI=key.bin,METHOD=AES-128'
+        self.assertEqual(_parse_key_uri(line), 'key.bin')
+        self.assertEqual(_parse_key_iv(line), '0x0f')
+
+    def test_missing_iv(self):
+        line = '#EXT-X-KEY:METHOD=AES-128,URI="key.bin"'
+        self.assertEqual(_parse_key_uri(line), 'key.bin')
+        self.assertIsNone(_parse_key_iv(line))
+
+    def test_iv_inside_uri_is_ignored(self):
+        line = '#EXT-X-KEY:METHOD=AES-128,URI="key?IV=1"'
+        self.assertIsNone(_parse_key_iv(line))
+
+    def test_unsupported_method_or_missing_uri(self):
+        self.assertIsNone(_parse_key_uri('#EXT-X-KEY:METHOD=NONE'))
+        self.assertIsNone(_parse_key_uri('#EXT-X-KEY:METHOD=AES-128'))
+        self.assertIsNone(_parse_key_uri('#EXT-X-KEY:METHOD=AES-128,URI=""'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+"""
+rate_limiter 并发控制与限速测试
+"""
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rate_limiter import AIMDConcurrencyLimiter, HostRateLimiter
+
+
+class FakeClock:
+    """可控的时钟，sleep时直接推进时间并记录等待时长"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class AIMDConcurrencyLimiterTest(unittest.TestCase):
+
+    def _run(self, limiter, latency=None, overloaded=False):
+        limiter.acquire()
+        limiter.release('example.com', latency, overloaded)
+
+    def test_increase_is_bounded_by_max_limit(self):
+        limiter = AIMDConcurrencyLimiter(2, max_limit=4, target_latency=1.0)
+        for _ in range(10):
+            self._run(limiter, latency=0.5)
+        self.assertEqual(limiter.limit, 4)
+
+    def test_overload_halves_down_to_min_limit(self):
+        limiter = AIMDConcurrencyLimiter(8, min_limit=2, max_limit=8)
+        self._run(limiter, overloaded=True)
+        self.assertEqual(limiter.limit, 4)
+        for _ in range(5):
+            self._run(limiter, overloaded=True)
+        self.assertEqual(limiter.limit, 2)
+
+    def test_slow_requests_do_not_increase(self):
+        limiter = AIMDConcurrencyLimiter(3, max_limit=6, target_latency=1.0)
+        self._run(limiter, latency=5.0)
+        self.assertEqual(limiter.limit, 3)
+
+    def test_release_without_latency_keeps_limit(self):
+        """没有发出请求（如链接失效）时不调整并发数"""
+        limiter = AIMDConcurrencyLimiter(3, max_limit=6)
+        self._run(limiter)
+        self.assertEqual(limiter.limit, 3)
+        self.assertEqual(limiter.in_flight, 0)
+
+    def test_initial_limit_is_clamped(self):
+        limiter = AIMDConcurrencyLimiter(10, max_limit=4)
+        self.assertEqual(limiter.limit, 4)
+
+
+class HostRateLimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch('rate_limiter.time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_rpm_zero_is_unlimited(self):
+        limiter = HostRateLimiter(rpm=0)
+        for _ in range(1000):
+            limiter.wait_if_throttled('example.com')
+        self.assertEqual(self.clock.sleeps, [])
+
+    def test_rpm_limit_waits_for_window(self):
+        limiter = HostRateLimiter(rpm=3)
+        for _ in range(3):
+            limiter.wait_if_throttled('example.com')
+        self.assertEqual(self.clock.sleeps, [])
+        limiter.wait_if_throttled('example.com')
+        self.assertEqual(self.clock.sleeps, [60.0])
+        # 其他主机不受影响
+        limiter.wait_if_throttled('other.com')
+        self.assertEqual(len(self.clock.sleeps), 1)
+
+    def test_defer_blocks_host_even_when_unlimited(self):
+        """rpm为0时仍然遵守429的Retry-After"""
+        limiter = HostRateLimiter(rpm=0)
+        limiter.defer('example.com', 5)
+        limiter.wait_if_throttled('example.com')
+        self.assertEqual(self.clock.sleeps, [5.0])
+        limiter.wait_if_throttled('other.com')
+        self.assertEqual(self.clock.sleeps, [5.0])
+
+    def test_defer_keeps_the_later_deadline(self):
+        limiter = HostRateLimiter(rpm=10)
+        limiter.defer('example.com', 10)
+        limiter.defer('example.com', 2)
+        limiter.wait_if_throttled('example.com')
+        self.assertEqual(sum(self.clock.sleeps), 10.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
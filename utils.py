@@ -5,20 +5,32 @@ import os
 import hashlib
 import json
 import time
+import tempfile
 from urllib.parse import urlparse, urljoin
 from datetime import datetime
+try:
+    import orjson  # 可选依赖，安装后加快JSON序列化
+except ImportError:
+    orjson = None
 from config import DEFAULT_OUTPUT_DIR
 
+def url_hash_hex(url, digest_size=16):
+    """计算URL的哈希值（BLAKE2b，默认32个十六进制字符）"""
+    return hashlib.blake2b(url.encode(), digest_size=digest_size).hexdigest()
+
 def create_temp_dir(m3u8_url, base_dir=None):
     """创建临时目录"""
     # 如果没有指定基础目录，则使用默认输出目录
     if base_dir is None:
         base_dir = DEFAULT_OUTPUT_DIR
     
-    url_hash = hashlib.md5(m3u8_url.encode()).hexdigest()
-    temp_dir = os.path.join(base_dir, url_hash)
-    if not os.path.exists(temp_dir):
-        os.makedirs(temp_dir)
+    temp_dir = os.path.join(base_dir, url_hash_hex(m3u8_url))
+    if not os.path.isdir(temp_dir):
+        # 兼容旧版本以MD5命名的临时目录，保证可以继续断点续传
+        legacy_dir = os.path.join(base_dir, hashlib.md5(m3u8_url.encode(), usedforsecurity=False).hexdigest())
+        if os.path.isdir(legacy_dir):
+            return legacy_dir
+    os.makedirs(temp_dir, exist_ok=True)
     return temp_dir
 
 def get_base_url(m3u8_url):
@@ -47,7 +59,7 @@ def generate_output_filename(m3u8_url):
     parsed_url = urlparse(m3u8_url)
     domain = parsed_url.netloc.replace('.', '_')  # 将域名中的点替换为下划线
     timestamp = time.strftime('%Y%m%d_%H%M%S')  # 添加时间戳
-    random_str = hashlib.md5(m3u8_url.encode()).hexdigest()[:8]  # 基于URL生成随机字符串
+    random_str = url_hash_hex(m3u8_url, digest_size=4)  # 基于URL生成随机字符串
     return f"{domain}_{timestamp}_{random_str}.mp4"
 
 def save_download_state(state_file, downloaded_segments, failed_segments):
@@ -92,12 +104,55 @@ def load_download_state(state_file, temp_dir):
     
     return downloaded_segments, failed_segments
 
+def load_manifest_cache(manifest_file):
+    """加载缓存的M3U8内容"""
+    if not os.path.exists(manifest_file):
+        return None
+    try:
+        with open(manifest_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"加载M3U8缓存失败: {e}")
+        return None
+
+def save_manifest_cache(manifest_file, manifest):
+    """缓存M3U8内容"""
+    try:
+        manifest['cached_time'] = time.time()
+        with open(manifest_file, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+    except Exception as e:
+        print(f"保存M3U8缓存失败: {e}")
+
+def dump_json_bytes(data):
+    """将数据序列化为带缩进的UTF-8 JSON字节串"""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+    return json.dumps(data, ensure_ascii=False, indent=2).encode('utf-8')
+
+def dump_json_line(data):
+    """将数据序列化为一行UTF-8 JSON（NDJSON格式）"""
+    if orjson is not None:
+        return orjson.dumps(data) + b'\n'
+    return json.dumps(data, ensure_ascii=False).encode('utf-8') + b'\n'
+
+def write_file_atomic(file_path, data):
+    """先写入同目录下的临时文件再重命名，避免中断时留下不完整的文件"""
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(file_path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, file_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
 def save_download_report(output_base_dir, report_data):
     """保存下载报告"""
     try:
         report_file = os.path.join(output_base_dir, f'download_report_{datetime.now().strftime("%Y%m%d_%H%M%S")}.json')
-        with open(report_file, 'w', encoding='utf-8') as f:
-            json.dump(report_data, f, ensure_ascii=False, indent=2)
+        write_file_atomic(report_file, dump_json_bytes(report_data))
         print(f"\n下载报告已保存: {report_file}")
         return report_file
     except Exception as e: